@@ -8,27 +8,62 @@ from config import *
 from datetime import timedelta
 from cloudinary import config
 
-app = Flask(__name__)
+# Extensions are created unbound so models can import db before an app exists. The Mongo
+# client is created with connect=False and only opens its pool on the first query, which
+# happens in the worker after gunicorn forks; background pools are also created lazily.
+db = MongoEngine()
+jwt = JWTManager()
+cors = CORS()
 
-app.config.from_object(ProductionConfig)
 
-# MongoEngine
-db = MongoEngine(app)
+# FUNCTION create_app()
+def create_app(config_object=ProductionConfig):
+    app = Flask(__name__)
 
-# JWT Configuration
-app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(hours=1)
-app.config['JWT_REFRESH_TOKEN_EXPIRES'] = timedelta(days=30)
-jwt = JWTManager(app)
+    app.config.from_object(config_object)
 
-# Enabling CORS
-cors = CORS(app, supports_credentials=True)
+    # JSON encoder, set before MongoEngine wraps it
+    from controllers.encoder import JSONEncoder
+    app.json_encoder = JSONEncoder
 
-# Cloudinary
-config(cloud_name=os.environ['CLOUD_NAME'], api_key=os.environ['API_KEY'], api_secret=os.environ['API_SECRET'])
+    # Request metrics, registered before MongoEngine creates the client
+    from controllers.metrics import init_metrics
+    init_metrics(app)
 
-# Blueprints
-from controllers.user import user_bp
-from controllers.post import post_bp
+    # MongoEngine
+    db.init_app(app)
 
-app.register_blueprint(user_bp)
-app.register_blueprint(post_bp)
\ No newline at end of file
+    # JWT Configuration
+    app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(hours=1)
+    app.config['JWT_REFRESH_TOKEN_EXPIRES'] = timedelta(days=30)
+    jwt.init_app(app)
+
+    # Enabling CORS
+    cors.init_app(app, supports_credentials=True)
+
+    # Cloudinary
+    config(cloud_name=os.environ['CLOUD_NAME'], api_key=os.environ['API_KEY'], api_secret=os.environ['API_SECRET'])
+
+    # Post card cache
+    from controllers.cache import init_cache
+    init_cache(app)
+
+    # Live update events
+    from controllers.events import init_events
+    init_events(app)
+
+    # Blueprints
+    from controllers.user import user_bp
+    from controllers.post import post_bp
+
+    from controllers.batch import batch_bp
+
+    app.register_blueprint(user_bp)
+    app.register_blueprint(post_bp)
+    app.register_blueprint(batch_bp)
+
+    # CLI commands
+    from commands import commands_bp
+    app.register_blueprint(commands_bp)
+
+    return app
@@ -0,0 +1,14 @@
+# benchutil.py
+#
+# Helpers shared by the benchmark scripts, which import it from their own directory.
+#
+# The scripts need the app's requirements, plus the packages in bench/requirements.txt to
+# run against mongomock instead of a MongoDB server:
+#
+#   pip install -r requirements.txt -r bench/requirements.txt
+
+
+# FUNCTION percentile()
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)] if values else 0.0
@@ -0,0 +1,162 @@
+# hot_post.py
+#
+# Load test for a viral post. CLIENTS threads, each logged in as its own user, like and
+# unlike the same post as fast as they can for DURATION seconds through the app's test
+# client. The script reports the requests per second, latency percentiles and how many
+# writes reached the post document. It then checks that the post's counters match its Like
+# and Retweet documents once everything has been flushed. Compare the direct writes with
+# the counter buffer:
+#
+#   MONGODB_HOST='mongodb://localhost:27017/bench?tlsCAFile=' python bench/hot_post.py --flush 0
+#   MONGODB_HOST='mongodb://localhost:27017/bench?tlsCAFile=' python bench/hot_post.py --flush 1
+#
+# The database is dropped before seeding, so its name must contain "bench".
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchutil import percentile
+
+
+POST_COLLECTION = 'post' # Post's collection; models cannot be imported before create_app()
+
+
+# FUNCTION count_post_writes()
+# Counts the update commands sent to the posts collection, through the pymongo command
+# listener or, on mongomock, by wrapping its collection methods. pymongo only passes events
+# to listeners registered before the client is created, so this runs before create_app().
+def count_post_writes(host):
+    from pymongo import monitoring
+
+    writes = [0]
+
+    if host.startswith('mongomock://'):
+        import mongomock
+
+        for name in ('update_one', 'bulk_write'):
+            def wrapper(self, *args, method=getattr(mongomock.collection.Collection, name), **kwargs):
+                if self.name == POST_COLLECTION:
+                    writes[0] += 1
+
+                return method(self, *args, **kwargs)
+
+            setattr(mongomock.collection.Collection, name, wrapper)
+    else:
+        class Listener(monitoring.CommandListener):
+            def started(self, event):
+                if event.command_name == 'update' and event.command.get('update') == POST_COLLECTION:
+                    writes[0] += 1
+
+            def succeeded(self, event):
+                pass
+
+            def failed(self, event):
+                pass
+
+        monitoring.register(Listener())
+
+    return writes
+
+
+# FUNCTION main()
+def main():
+    parser = argparse.ArgumentParser(description='Hot post load test')
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--flush', type=float, default=1.0, help='COUNTER_FLUSH_SECONDS; 0 writes every change directly')
+    parser.add_argument('--retweets', action='store_true', help='Also retweet and unretweet the post')
+    options = parser.parse_args()
+
+    os.environ.setdefault('CACHE_BACKEND', 'none')
+    os.environ['COUNTER_FLUSH_SECONDS'] = str(options.flush)
+
+    host = os.environ['MONGODB_HOST']
+
+    if 'bench' not in host.split('?')[0].rsplit('/', 1)[-1]:
+        sys.exit(f'Refusing to drop {host}: the database name must contain "bench"')
+
+    writes = count_post_writes(host)
+
+    from app import create_app
+    from flask_jwt_extended import create_access_token
+
+    app = create_app()
+    app.config['SLOW_REQUEST_MS'] = 10 ** 9
+
+    from models.user import User
+    from models.post import Post
+    from models.like import Like
+    from models.retweet import Retweet
+    from controllers.counters import flush_counters
+
+    if Post._get_collection_name() != POST_COLLECTION:
+        sys.exit(f'Post is stored in {Post._get_collection_name()}, update POST_COLLECTION')
+
+    with app.app_context():
+        for document in (User, Post, Like, Retweet):
+            document.drop_collection()
+            document.ensure_indexes()
+
+        password = User.createPassword('bench-password')
+        users = [User(full_name=f'Bench User {index}', username=f'bench{index}', password=password).save() for index in range(options.clients + 1)]
+        post = Post(author=users[0].id, text='Going viral').save()
+        tokens = [create_access_token(identity=str(user.id)) for user in users[1:]]
+
+    client = app.test_client()
+    relations = ['like', 'retweet'] if options.retweets else ['like']
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    deadline = time.monotonic() + options.duration
+    writes[0] = 0
+
+    def worker(token):
+        headers = { 'Authorization': f'Bearer {token}' }
+        step = 0
+
+        while time.monotonic() < deadline:
+            relation = relations[step // 2 % len(relations)]
+            method = client.post if step % 2 == 0 else client.delete
+            started = time.perf_counter()
+            response = method(f'/post/{relation}/{post.id}', headers=headers)
+            elapsed = time.perf_counter() - started
+
+            with lock:
+                (latencies if response.status_code < 400 else errors).append(elapsed)
+
+            step += 1
+
+    threads = [threading.Thread(target=worker, args=(token,)) for token in tokens]
+    started = time.monotonic()
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.monotonic() - started
+    flush_counters()
+
+    with app.app_context():
+        counts = Post.objects(id=post.id).only('likes_count', 'retweets_count').as_pymongo().first()
+        expected = { 'likes_count': Like.objects(post_id=post.id).count(), 'retweets_count': Retweet.objects(post_id=post.id).count() }
+
+    print(f'flush={options.flush}s clients={options.clients} duration={elapsed:.1f}s requests={len(latencies)} errors={len(errors)}')
+    print(f'throughput={len(latencies) / elapsed:.1f}/s p50={percentile(latencies, 0.5) * 1000:.1f}ms p95={percentile(latencies, 0.95) * 1000:.1f}ms '
+        f'p99={percentile(latencies, 0.99) * 1000:.1f}ms')
+    print(f'post_writes={writes[0]} ({writes[0] / max(len(latencies), 1):.3f} per request)')
+
+    for field, value in expected.items():
+        if counts.get(field, 0) != value:
+            sys.exit(f'MISMATCH {field}: stored {counts.get(field, 0)}, expected {value}')
+
+    print(f'counters ok: {expected}')
+
+
+if __name__ == '__main__':
+    main()
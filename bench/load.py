@@ -0,0 +1,75 @@
+# load.py
+#
+# HTTP load test against a running server. CLIENTS threads request PATHS in a loop for
+# DURATION seconds and the script reports requests per second, per core and latency
+# percentiles. Compare the default sync worker with the threaded one on the same cores:
+#
+#   gunicorn -w 1 -k sync 'app:create_app()' --bind :8000
+#   gunicorn -w 1 -k gthread --threads 8 'app:create_app()' --bind :8000
+#   python bench/load.py --url http://localhost:8000 --token $TOKEN --cores 1 /post /timeline
+#
+# Run the server against a real mongod. With MONGODB_HOST on mongomock, handlers never wait
+# on the network, so the numbers say nothing about what threads gain on I/O-bound requests.
+
+import argparse
+import threading
+import time
+import urllib.error
+import urllib.request
+from benchutil import percentile
+
+
+# FUNCTION main()
+def main():
+    parser = argparse.ArgumentParser(description='HTTP load test')
+    parser.add_argument('paths', nargs='+')
+    parser.add_argument('--url', default='http://localhost:8000')
+    parser.add_argument('--token', help='JWT access token sent as a Bearer header')
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=20.0)
+    parser.add_argument('--cores', type=int, default=1, help='Cores given to the server')
+    options = parser.parse_args()
+
+    headers = { 'Authorization': f'Bearer {options.token}' } if options.token else {}
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    deadline = time.monotonic() + options.duration
+
+    def worker(index):
+        while time.monotonic() < deadline:
+            request = urllib.request.Request(options.url + options.paths[index % len(options.paths)], headers=headers)
+            started = time.monotonic()
+
+            try:
+                with urllib.request.urlopen(request, timeout=30) as response:
+                    response.read()
+                ok = True
+            except (urllib.error.URLError, OSError):
+                ok = False
+
+            elapsed = time.monotonic() - started
+
+            with lock:
+                (latencies if ok else errors).append(elapsed)
+
+            index += 1
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(options.clients)]
+    started = time.monotonic()
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.monotonic() - started
+    throughput = len(latencies) / elapsed
+
+    print(f'clients={options.clients} duration={elapsed:.1f}s requests={len(latencies)} errors={len(errors)}')
+    print(f'throughput={throughput:.1f}/s per_core={throughput / options.cores:.1f}/s')
+    print(f'p50={percentile(latencies, 0.5) * 1000:.1f}ms p95={percentile(latencies, 0.95) * 1000:.1f}ms p99={percentile(latencies, 0.99) * 1000:.1f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+# login.py
+#
+# Measures login throughput under concurrency. Users are registered once, then CLIENTS
+# threads log in through the app's test client for DURATION seconds. The app runs against the
+# database in MONGODB_HOST, so point it at a scratch database.
+#
+#   python bench/login.py --clients 16 --duration 10 --rounds 12
+#
+# Compare runs with different PASSWORD_WORKERS and BCRYPT_LOG_ROUNDS values. Under gunicorn,
+# the pool only frees other requests when workers are threaded (see Procfile).
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchutil import percentile
+
+
+# FUNCTION main()
+def main():
+    parser = argparse.ArgumentParser(description='Login throughput benchmark')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--rounds', type=int, default=None, help='BCRYPT_LOG_ROUNDS')
+    parser.add_argument('--workers', type=int, default=None, help='PASSWORD_WORKERS')
+    options = parser.parse_args()
+
+    from app import create_app
+    from models.user import User
+
+    app = create_app()
+
+    if options.rounds is not None:
+        app.config['BCRYPT_LOG_ROUNDS'] = options.rounds
+    if options.workers is not None:
+        app.config['PASSWORD_WORKERS'] = options.workers
+
+    client = app.test_client()
+    usernames = [f'bench_login_{index}' for index in range(options.users)]
+
+    with app.app_context():
+        User.objects(username__in=usernames).delete()
+
+    for username in usernames:
+        client.post('/register', json={ 'full_name': 'Bench User', 'username': username, 'password': 'bench-password' })
+
+    latencies = []
+    failures = []
+    lock = threading.Lock()
+    deadline = time.monotonic() + options.duration
+
+    def worker(index):
+        while time.monotonic() < deadline:
+            started = time.monotonic()
+            response = client.post('/login', json={ 'username': usernames[index % len(usernames)], 'password': 'bench-password' })
+            elapsed = time.monotonic() - started
+
+            with lock:
+                (latencies if response.status_code == 200 else failures).append(elapsed)
+
+            index += options.clients
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(options.clients)]
+    started = time.monotonic()
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.monotonic() - started
+
+    print(f'clients={options.clients} rounds={app.config["BCRYPT_LOG_ROUNDS"]} workers={app.config["PASSWORD_WORKERS"]}')
+    print(f'logins={len(latencies)} failures={len(failures)} throughput={len(latencies) / elapsed:.1f}/s')
+    print(f'p50={percentile(latencies, 0.5) * 1000:.1f}ms p95={percentile(latencies, 0.95) * 1000:.1f}ms p99={percentile(latencies, 0.99) * 1000:.1f}ms')
+
+    with app.app_context():
+        User.objects(username__in=usernames).delete()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,344 @@
+# suite.py
+#
+# Seeds a scratch database with a synthetic social graph and times the read endpoints at
+# several data sizes. The graph has power-law follower counts, reply threads DEPTH levels
+# deep and hot posts with many likes. Cloudinary is replaced by an in-process fake. For each
+# size and endpoint it reports latency percentiles and the Mongo commands per request.
+#
+#   pip install -r bench/requirements.txt   # mongomock, for the first command
+#   MONGODB_HOST='mongomock://localhost/bench?tlsCAFile=' python bench/suite.py --scales 0.1,1
+#   MONGODB_HOST='mongodb://localhost:27017/bench?tlsCAFile=' python bench/suite.py \
+#       --users 10000 --posts 1000000 --hot-likes 100000 --scales 0.01,0.1,1
+#
+# --output writes the results as JSON. --baseline compares them with an earlier file and
+# exits with status 1 when a p95 or a query count grew by more than --tolerance, so CI can
+# catch regressions. Query counts are deterministic for a given seed and graph.
+#
+# The database is dropped before seeding, so its name must contain "bench".
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchutil import percentile
+
+ENDPOINTS = ('get_all_posts', 'timeline', 'get_post_info', 'search', 'get_user_posts')
+HASHTAGS = ('news', 'music', 'sports', 'python', 'flask', 'mongo', 'art', 'travel')
+
+
+# CLASS FakeMedia
+# In-process stand-in for Cloudinary with the interface of controllers.media.CloudinaryMedia.
+class FakeMedia:
+    def __init__(self):
+        self.resources = {}
+
+    def upload(self, path, folder, public_id):
+        resource = {
+            'public_id': f'{folder}/{public_id}',
+            'secure_url': f'https://fake.cloudinary.test/{folder}/{public_id}.jpg',
+            'width': 640,
+            'height': 480,
+            'bytes': 1024
+        }
+        self.resources[resource['public_id']] = resource
+        return resource
+
+    def delete_resources(self, public_ids):
+        for public_id in public_ids:
+            self.resources.pop(public_id, None)
+
+    def delete_resources_by_prefix(self, prefix):
+        for public_id in [public_id for public_id in self.resources if public_id.startswith(prefix)]:
+            del self.resources[public_id]
+
+    def delete_folder(self, folder):
+        pass
+
+
+# FUNCTION count_mongomock_calls()
+# mongomock does not emit pymongo monitoring events, so its collection methods report to the
+# request stats directly. Against a real server the command listener counts them.
+def count_mongomock_calls():
+    import mongomock
+    from controllers.metrics import current_stats
+
+    def counted(method):
+        def wrapper(self, *args, **kwargs):
+            stats = current_stats()
+
+            if stats is not None:
+                stats.mongo_commands += 1
+
+            return method(self, *args, **kwargs)
+
+        return wrapper
+
+    for name in ('find', 'find_one', 'aggregate', 'count_documents', 'insert_one', 'insert_many', 'update_one', 'update_many',
+        'delete_one', 'delete_many', 'bulk_write', 'find_one_and_update', 'distinct'):
+        setattr(mongomock.collection.Collection, name, counted(getattr(mongomock.collection.Collection, name)))
+
+
+# FUNCTION seed()
+# Inserts the graph with bulk writes and returns the ids the endpoints are driven with.
+def seed(options, scale, rng, media):
+    from bson import ObjectId
+    from models.user import User
+    from models.post import Post, Image
+    from models.follow import Follow
+    from models.like import Like
+    from models.retweet import Retweet
+    from models.timeline import TimelineEntry
+
+    for document in (User, Post, Follow, Like, Retweet, TimelineEntry):
+        document.drop_collection()
+        document.ensure_indexes()
+
+    users = max(int(options.users * scale), 10)
+    posts = max(int(options.posts * scale), users)
+    password = User.createPassword('bench-password')
+
+    # Users
+    user_ids = [ObjectId() for _ in range(users)]
+    followers = { user_id: set() for user_id in user_ids }
+
+    # Power-law follower counts: most accounts have a handful, a few have most of the graph
+    for user_id in user_ids:
+        for follower_id in rng.sample(user_ids, min(users - 1, int(rng.paretovariate(options.alpha)))):
+            if follower_id != user_id:
+                followers[user_id].add(follower_id)
+
+    following = { user_id: 0 for user_id in user_ids }
+
+    for user_id in user_ids:
+        for follower_id in followers[user_id]:
+            following[follower_id] += 1
+
+    User._get_collection().insert_many([User(id=user_id, full_name=f'Bench User {index}', username=f'bench{index}', password=password,
+        followers_count=len(followers[user_id]), following_count=following[user_id], **User.searchFields(f'Bench User {index}', f'bench{index}')).to_mongo()
+        for index, user_id in enumerate(user_ids)])
+    edges = [Follow(follower=follower_id, following=user_id).to_mongo() for user_id in user_ids for follower_id in followers[user_id]]
+
+    if edges:
+        Follow._get_collection().insert_many(edges)
+
+    # Top-level posts, oldest first so that _id order matches date order
+    started = datetime.now() - timedelta(days=30)
+    rows = []
+
+    for index in range(posts):
+        author_id = rng.choice(user_ids)
+        text = f'Post {index} #{rng.choice(HASHTAGS)} @bench{rng.randrange(users)}'
+        post = Post(id=ObjectId(), author=author_id, text=text, date=started + timedelta(seconds=index))
+
+        if rng.random() < options.image_ratio:
+            post.images = [Image(url=resource['secure_url'], public_id=resource['public_id'], width=resource['width'], height=resource['height'],
+            bytes=resource['bytes']) for resource in [media.upload(None, f'hashtage/{author_id}/{post.id}', '1')]]
+
+        post.clean()
+        rows.append(post.to_mongo())
+
+    Post._get_collection().insert_many(rows)
+    post_ids = [row['_id'] for row in rows]
+
+    # Reply threads: the newest posts get a tree of replies DEPTH levels deep
+    threads = post_ids[-options.threads:]
+    comments = {}
+    replies = []
+
+    for root_id in threads:
+        level = [(root_id, [])]
+
+        for depth in range(1, options.depth + 1):
+            next_level = []
+
+            for parent_id, ancestors in level:
+                for _ in range(options.branching):
+                    reply = Post(id=ObjectId(), author=rng.choice(user_ids), text=f'Reply at depth {depth}', parent=parent_id,
+                    ancestors=ancestors + [parent_id], depth=depth)
+                    reply.clean()
+                    replies.append(reply.to_mongo())
+                    comments[parent_id] = comments.get(parent_id, 0) + 1
+                    next_level.append((reply.id, ancestors + [parent_id]))
+
+            level = next_level
+
+    if replies:
+        Post._get_collection().insert_many(replies)
+
+    # Hot posts: the newest posts get likes from up to HOT_LIKES distinct users
+    hot = post_ids[-options.hot_posts:]
+    likes = {}
+
+    for post_id in hot:
+        likers = rng.sample(user_ids, min(users, max(int(options.hot_likes * scale), 1)))
+        Like._get_collection().insert_many([Like(user_id=user_id, post_id=post_id).to_mongo() for user_id in likers])
+        likes[post_id] = len(likers)
+
+    # A sprinkle of retweets
+    retweets = {}
+    retweet_rows = []
+
+    for user_id in rng.sample(user_ids, min(users, 50)):
+        post_id = rng.choice(post_ids)
+        retweet_rows.append(Retweet(user_id=user_id, post_id=post_id).to_mongo())
+        retweets[post_id] = retweets.get(post_id, 0) + 1
+
+    Retweet._get_collection().insert_many(retweet_rows)
+
+    from pymongo import UpdateOne
+
+    updates = [UpdateOne({ '_id': post_id }, { '$set': { 'comments_count': comments.get(post_id, 0), 'likes_count': likes.get(post_id, 0),
+        'retweets_count': retweets.get(post_id, 0) } }) for post_id in set(comments) | set(likes) | set(retweets)]
+
+    if updates:
+        Post._get_collection().bulk_write(updates, ordered=False)
+
+    return {
+        'users': users,
+        'posts': posts + len(replies),
+        'user_ids': user_ids,
+        'popular_user_ids': sorted(user_ids, key=lambda user_id: -len(followers[user_id]))[:10],
+        'thread_ids': threads,
+        'hot_ids': hot
+    }
+
+
+# FUNCTION drive()
+# Times requests to one endpoint as random viewers and collects their Mongo command counts.
+def drive(client, tokens, paths, requests, rng):
+    latencies = []
+    commands = []
+
+    for _ in range(requests):
+        token = rng.choice(tokens)
+        started = time.perf_counter()
+        response = client.get(rng.choice(paths), headers={ 'Authorization': f'Bearer {token}' })
+        latencies.append(time.perf_counter() - started)
+
+        if response.status_code != 200:
+            raise RuntimeError(f'{response.request.path} returned {response.status_code}: {response.get_data(as_text=True)[:200]}')
+
+        commands.append(int(response.headers.get('X-Mongo-Commands', 0)))
+
+    return {
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'queries': round(sum(commands) / len(commands), 2)
+    }
+
+
+# FUNCTION compare()
+# Returns the results that grew past the tolerance relative to the baseline.
+def compare(results, baseline, tolerance):
+    regressions = []
+
+    for size, endpoints in results.items():
+        for endpoint, result in endpoints.items():
+            previous = baseline.get(size, {}).get(endpoint)
+
+            if previous is None:
+                continue
+
+            for metric in ('p95_ms', 'queries'):
+                if result[metric] > previous[metric] * (1 + tolerance) and result[metric] - previous[metric] > 0.5:
+                    regressions.append(f'{size} {endpoint} {metric}: {previous[metric]} -> {result[metric]}')
+
+    return regressions
+
+
+# FUNCTION main()
+def main():
+    parser = argparse.ArgumentParser(description='Endpoint benchmark suite')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--posts', type=int, default=20000)
+    parser.add_argument('--alpha', type=float, default=1.2, help='Pareto shape of the follower counts')
+    parser.add_argument('--threads', type=int, default=5, help='Posts with reply trees')
+    parser.add_argument('--depth', type=int, default=6)
+    parser.add_argument('--branching', type=int, default=2)
+    parser.add_argument('--hot-posts', type=int, default=3)
+    parser.add_argument('--hot-likes', type=int, default=1000)
+    parser.add_argument('--image-ratio', type=float, default=0.2)
+    parser.add_argument('--scales', default='0.1,1', help='Comma separated multipliers of --users, --posts and --hot-likes')
+    parser.add_argument('--requests', type=int, default=50, help='Requests per endpoint and size')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output')
+    parser.add_argument('--baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    options = parser.parse_args()
+
+    os.environ.setdefault('CACHE_BACKEND', 'none')
+
+    from app import create_app
+    from flask_jwt_extended import create_access_token
+
+    app = create_app()
+    app.config['SLOW_REQUEST_MS'] = 10 ** 9
+
+    host = app.config['MONGODB_SETTINGS']['host']
+
+    if 'bench' not in host.split('?')[0].rsplit('/', 1)[-1]:
+        sys.exit(f'Refusing to drop {host}: the database name must contain "bench"')
+
+    if host.startswith('mongomock://'):
+        count_mongomock_calls()
+
+    import controllers.media
+
+    media = FakeMedia()
+    controllers.media.media_backend = lambda: media
+    client = app.test_client()
+    results = {}
+
+    for scale in [float(scale) for scale in options.scales.split(',')]:
+        rng = random.Random(options.seed)
+
+        with app.app_context():
+            started = time.perf_counter()
+            graph = seed(options, scale, rng, media)
+            app.test_cli_runner().invoke(args=['rebuild-timelines'])
+            tokens = [create_access_token(identity=str(user_id)) for user_id in rng.sample(graph['user_ids'], min(20, graph['users']))]
+            print(f'Seeded {graph["users"]} users and {graph["posts"]} posts in {time.perf_counter() - started:.1f}s')
+
+        # Query counts are read from the X-Mongo-Commands header. Set after the CLI call, which resets the flag
+        app.debug = True
+
+        paths = {
+            'get_all_posts': ['/post'],
+            'timeline': ['/timeline'],
+            'get_post_info': [f'/post/{post_id}' for post_id in graph['thread_ids'] + graph['hot_ids']],
+            'search': [f'/search/%23{tag}' for tag in HASHTAGS] + [f'/search/@bench{index}' for index in range(5)],
+            'get_user_posts': [f'/user/{user_id}' for user_id in graph['popular_user_ids']]
+        }
+
+        size = f'{graph["users"]}u/{graph["posts"]}p'
+        results[size] = {}
+
+        for endpoint in ENDPOINTS:
+            results[size][endpoint] = drive(client, tokens, paths[endpoint], options.requests, rng)
+            result = results[size][endpoint]
+            print(f'{size:>18} {endpoint:<15} p50={result["p50_ms"]:>8}ms p95={result["p95_ms"]:>8}ms p99={result["p99_ms"]:>8}ms queries={result["queries"]}')
+
+    if options.output:
+        with open(options.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    if options.baseline:
+        with open(options.baseline) as file:
+            regressions = compare(results, json.load(file), options.tolerance)
+
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
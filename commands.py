@@ -0,0 +1,364 @@
+# commands.py
+
+import click
+import shutil
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from bson import ObjectId
+from pymongo import UpdateOne
+from mongoengine.queryset.visitor import Q
+from cloudinary import api
+from flask import Blueprint, current_app
+from models.post import Post, Image, HASHTAG_RE, MENTION_RE
+from models.retweet import Retweet
+from models.like import Like
+from models.user import User
+from models.follow import Follow
+from models.timeline import TimelineEntry
+from controllers.fanout import backfill_inbox, pulled_accounts
+from controllers.purge import purge_post
+from controllers.media import media_backend
+from controllers.cache import invalidate_posts
+from controllers.pagination import DEFAULT_LIMIT
+from controllers.profile import compare_engines
+from controllers.metrics import cloudinary_call, metrics_server
+
+# Registered without a group, so the commands run as `flask <command>`
+commands_bp = Blueprint('commands', __name__, cli_group=None)
+
+BATCH_SIZE = 1000
+
+
+# FUNCTION count_by()
+def count_by(queryset, field):
+    pipeline = [{ '$group': { '_id': f'${field}', 'count': { '$sum': 1 } } }]
+    return { group['_id']: group['count'] for group in queryset.aggregate(pipeline) }
+
+
+# FUNCTION batches()
+def batches(queryset):
+    batch = []
+
+    for document in queryset:
+        batch.append(document)
+
+        if len(batch) == BATCH_SIZE:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+# reconcile_counters()
+# Recomputes the like, retweet and comment counters of every post from the source
+# collections and rewrites the ones that drifted. Tombstoned replies are not counted, as
+# delete_post() already took them off their parent.
+@commands_bp.cli.command('reconcile-counters')
+def reconcile_counters():
+    fixed = 0
+
+    for posts in batches(Post.objects.only('likes_count', 'retweets_count', 'comments_count').as_pymongo()):
+        post_ids = [post['_id'] for post in posts]
+
+        likes_count = count_by(Like.objects(post_id__in=post_ids), 'post_id')
+        retweets_count = count_by(Retweet.objects(post_id__in=post_ids), 'post_id')
+        comments_count = count_by(Post.objects(parent__in=post_ids, deleted__ne=True), 'parent')
+
+        updates = []
+
+        for post in posts:
+            counters = {
+                'likes_count': likes_count.get(post['_id'], 0),
+                'retweets_count': retweets_count.get(post['_id'], 0),
+                'comments_count': comments_count.get(post['_id'], 0)
+            }
+
+            if any(post.get(field) != value for field, value in counters.items()):
+                updates.append(UpdateOne({ '_id': post['_id'] }, { '$set': counters }))
+
+        if updates:
+            Post._get_collection().bulk_write(updates, ordered=False)
+            fixed += len(updates)
+
+    print(f'Reconciled counters on {fixed} posts')
+
+
+# backfill_images()
+# One-off migration for posts uploaded before image urls were stored on Post.
+@commands_bp.cli.command('backfill-images')
+def backfill_images():
+    filled = 0
+
+    for post in Post.objects(img_path__ne=None, images__size=0).no_dereference():
+        resources = cloudinary_call(api.resources, type='upload', prefix=post.img_path, max_results=500)['resources']
+        images = [Image(url=resource['secure_url'], public_id=resource['public_id'], width=resource.get('width'), height=resource.get('height'),
+        bytes=resource.get('bytes')) for resource in sorted(resources, key=lambda resource: resource['public_id'])]
+
+        post.update(images=images)
+        filled += 1
+
+    print(f'Backfilled images on {filled} posts')
+
+
+# rebuild_timelines()
+# Fills the timeline inboxes from the existing follow graph, e.g. after a first deploy.
+@commands_bp.cli.command('rebuild-timelines')
+def rebuild_timelines():
+    limit = current_app.config['FANOUT_BACKFILL']
+
+    for user in User.objects.only('id').as_pymongo():
+        following = [follow['following'] for follow in Follow.objects(follower=user['_id']).only('following').as_pymongo()]
+        pulled = set(pulled_accounts(following))
+
+        for followed_id in following:
+            if followed_id not in pulled:
+                backfill_inbox(user['_id'], followed_id, limit)
+
+    print('Rebuilt timelines')
+
+
+# backfill_ancestors()
+# One-off migration that stores the ancestors and depth of existing replies, walking the
+# reply trees one level at a time from the top-level posts.
+@commands_bp.cli.command('backfill-ancestors')
+def backfill_ancestors():
+    level = { post['_id']: [] for post in Post.objects(parent=None).only('id').as_pymongo() }
+    filled = 0
+
+    while level:
+        next_level = {}
+
+        for parents in batches(list(level)):
+            updates = []
+
+            for reply in Post.objects(parent__in=parents).only('parent').as_pymongo():
+                ancestors = level[reply['parent']] + [reply['parent']]
+                next_level[reply['_id']] = ancestors
+                updates.append(UpdateOne({ '_id': reply['_id'] }, { '$set': { 'ancestors': ancestors, 'depth': len(ancestors) } }))
+
+            if updates:
+                Post._get_collection().bulk_write(updates, ordered=False)
+                filled += len(updates)
+
+        level = next_level
+
+    print(f'Backfilled ancestors on {filled} replies')
+
+
+# purge_deleted()
+# Finishes the cascade deletes of tombstoned posts whose background job did not complete.
+@commands_bp.cli.command('purge-deleted')
+def purge_deleted():
+    post_ids = list(Post.objects(deleted=True).scalar('id'))
+
+    for post_id in post_ids:
+        purge_post(post_id, media_backend())
+
+    print(f'Purged {len(post_ids)} deleted posts')
+
+
+# sweep_uploads()
+# Marks failed the posts whose images are still pending after --minutes, as left by a worker
+# that died mid-upload, and removes spool directories older than that.
+@commands_bp.cli.command('sweep-uploads')
+@click.option('--minutes', default=60, help='Age after which a pending upload is given up')
+def sweep_uploads(minutes):
+    cutoff = ObjectId.from_datetime(datetime.now(timezone.utc) - timedelta(minutes=minutes))
+    post_ids = list(Post.objects(id__lt=cutoff, media_status='pending').scalar('id'))
+
+    if post_ids:
+        Post.objects(id__in=post_ids, media_status='pending').update(set__media_status='failed')
+        invalidate_posts(*post_ids)
+
+    removed = 0
+
+    for spool in Path(current_app.config['UPLOAD_SPOOL_DIR']).glob('*'):
+        if ObjectId.is_valid(spool.name) and ObjectId(spool.name) < cutoff:
+            shutil.rmtree(spool, ignore_errors=True)
+            removed += 1
+
+    print(f'Marked {len(post_ids)} stale uploads failed, removed {removed} spool directories')
+
+
+# build_search_index()
+# Creates the search indexes and fills the fields they cover for posts and users written
+# before search was indexed. New and edited documents keep them current on their own.
+@commands_bp.cli.command('build-search-index')
+def build_search_index():
+    Post.ensure_indexes()
+    User.ensure_indexes()
+
+    for posts in batches(Post.objects.only('text').as_pymongo()):
+        Post._get_collection().bulk_write([UpdateOne({ '_id': post['_id'] }, { '$set': {
+            'hashtags': sorted({ tag.lower() for tag in HASHTAG_RE.findall(post.get('text', '')) }),
+            'mentions': sorted({ username.lower() for username in MENTION_RE.findall(post.get('text', '')) })
+        } }) for post in posts], ordered=False)
+
+    for users in batches(User.objects.only('full_name', 'username').as_pymongo()):
+        User._get_collection().bulk_write([UpdateOne({ '_id': user['_id'] }, {
+            '$set': User.searchFields(user.get('full_name', ''), user.get('username', ''))
+        }) for user in users], ordered=False)
+
+    print('Built search index')
+
+
+# migrate_follows()
+# Moves the follow graph out of the embedded followers/following lists into Follow edges and
+# recomputes the stored follower and following counters. Safe to run again.
+@commands_bp.cli.command('migrate-follows')
+def migrate_follows():
+    Follow.ensure_indexes()
+    users = User._get_collection()
+
+    for user in users.find({ 'following.0': { '$exists': True } }, { 'following': 1 }):
+        edges = [UpdateOne({ 'follower': user['_id'], 'following': followed },
+        { '$setOnInsert': { 'follower': user['_id'], 'following': followed } }, upsert=True) for followed in set(user['following'])]
+        Follow._get_collection().bulk_write(edges, ordered=False)
+
+    users.update_many({}, { '$unset': { 'followers': '', 'following': '' } })
+
+    for field, counter in (('follower', 'following_count'), ('following', 'followers_count')):
+        users.update_many({}, { '$set': { counter: 0 } })
+
+        for groups in batches(Follow.objects.aggregate([{ '$group': { '_id': f'${field}', 'count': { '$sum': 1 } } }])):
+            users.bulk_write([UpdateOne({ '_id': group['_id'] }, { '$set': { counter: group['count'] } }) for group in groups], ordered=False)
+
+    print('Migrated follows')
+
+
+# FUNCTION remove_duplicates()
+# Keeps the oldest of each (user_id, post_id) pair so the unique indexes can be built. Works
+# on the raw collection, so nothing tries to build the indexes before duplicates are gone.
+def remove_duplicates(document):
+    collection = document._get_db()[document._get_collection_name()]
+    pipeline = [
+        { '$group': { '_id': { 'user_id': '$user_id', 'post_id': '$post_id' }, 'ids': { '$push': '$_id' }, 'count': { '$sum': 1 } } },
+        { '$match': { 'count': { '$gt': 1 } } }
+    ]
+    duplicates = [id for group in collection.aggregate(pipeline, allowDiskUse=True) for id in sorted(group['ids'])[1:]]
+
+    for start in range(0, len(duplicates), BATCH_SIZE):
+        collection.delete_many({ '_id': { '$in': duplicates[start:start + BATCH_SIZE] } })
+
+    return len(duplicates)
+
+
+# FUNCTION controller_queries()
+# One queryset per query shape issued by the controllers and background jobs.
+def controller_queries():
+    user_id, post_id = ObjectId(), ObjectId()
+
+    return {
+        'register / typeahead (username)': User.objects(username_lower='name'),
+        'login': User.objects(username='name'),
+        'authors': User.objects(id__in=[user_id]),
+        'search users': User.objects(Q(username_lower__startswith='na') | Q(name_tokens__startswith='na')),
+        'get_all_posts': Post.objects(parent=None, deleted__ne=True).order_by('-id'),
+        'hydrate posts': Post.objects(id__in=[post_id], deleted__ne=True),
+        'profile posts': Post.objects(author=user_id, deleted__ne=True).order_by('-id'),
+        'pulled posts': Post.objects(author__in=[user_id], parent=None, deleted__ne=True).order_by('-id'),
+        'thread replies': Post.objects(parent=post_id, deleted__ne=True, id__gt=post_id).order_by('id'),
+        'thread levels': Post.objects(parent__in=[post_id], deleted__ne=True).order_by('id'),
+        'subtree': Post.objects(ancestors=post_id),
+        'replies of posts': Post.objects(parent__in=[post_id]),
+        'search hashtag': Post.objects(hashtags='tag', deleted__ne=True).order_by('-id'),
+        'search mention': Post.objects(mentions='name', deleted__ne=True).order_by('-id'),
+        'search text': Post.objects(deleted__ne=True).search_text('word'),
+        'tombstoned posts': Post.objects(deleted=True),
+        'viewer likes': Like.objects(user_id=user_id, post_id__in=[post_id]),
+        'user likes': Like.objects(user_id=user_id).order_by('-id'),
+        'likes of posts': Like.objects(post_id__in=[post_id]),
+        'viewer retweets': Retweet.objects(user_id=user_id, post_id__in=[post_id]),
+        'profile retweets': Retweet.objects(user_id=user_id).order_by('-id'),
+        'pulled retweets': Retweet.objects(user_id__in=[user_id]).order_by('-id'),
+        'retweets of posts': Retweet.objects(post_id__in=[post_id]),
+        'is follower': Follow.objects(follower=user_id, following=user_id),
+        'followers': Follow.objects(following=user_id).order_by('-id'),
+        'following': Follow.objects(follower=user_id).order_by('-id'),
+        'timeline inbox': TimelineEntry.objects(owner=user_id).order_by('-item_id'),
+        'unfollow inbox': TimelineEntry.objects(owner=user_id, actor=user_id),
+        'inbox entries of posts': TimelineEntry.objects(post_id__in=[post_id]),
+        'inbox entries of retweets': TimelineEntry.objects(retweet_id__in=[post_id])
+    }
+
+
+# FUNCTION plan_stages()
+def plan_stages(plan):
+    stages = [plan.get('stage')]
+
+    for key in ('inputStage', 'queryPlan'):
+        if key in plan:
+            stages += plan_stages(plan[key])
+
+    for child in plan.get('inputStages', []):
+        stages += plan_stages(child)
+
+    return stages
+
+
+# build_indexes()
+# Removes duplicate likes and retweets, builds the indexes every model declares and explains
+# each controller query, flagging the ones that still scan a whole collection.
+@commands_bp.cli.command('build-indexes')
+def build_indexes():
+    for document in (Like, Retweet):
+        removed = remove_duplicates(document)
+
+        if removed:
+            print(f'Removed {removed} duplicate {document.__name__} documents, run `flask reconcile-counters`')
+
+    for document in (User, Post, Like, Retweet, Follow, TimelineEntry):
+        document.ensure_indexes()
+
+    scans = 0
+
+    for name, queryset in controller_queries().items():
+        stages = plan_stages(queryset.explain()['queryPlanner']['winningPlan'])
+        scans += 'COLLSCAN' in stages
+
+        print(f"{'COLLSCAN' if 'COLLSCAN' in stages else 'ok':<9} {name}: {' <- '.join(stage for stage in stages if stage)}")
+
+    print(f'{scans} queries scan a whole collection')
+
+
+# check_profile_parity()
+# Compares the Python and aggregation profile engines on a sample of users, each seen by
+# themselves, by a follower and by a stranger, over the first pages in both directions.
+@commands_bp.cli.command('check-profile-parity')
+@click.option('--samples', default=50, help='Users to compare')
+@click.option('--pages', default=3, help='Pages to follow per user and viewer')
+@click.option('--limit', default=DEFAULT_LIMIT, help='Page size')
+def check_profile_parity(samples, pages, limit):
+    user_ids = [user['_id'] for user in User._get_collection().aggregate([{ '$sample': { 'size': samples } }, { '$project': { '_id': 1 } }])]
+    strangers = [user['_id'] for user in User.objects.only('id').limit(2).as_pymongo()]
+    compared = 0
+    mismatches = 0
+
+    for user_id in user_ids:
+        follower = Follow.objects(following=user_id).only('follower').as_pymongo().first()
+        viewers = { user_id, next((stranger for stranger in strangers if stranger != user_id), user_id) }
+
+        if follower is not None:
+            viewers.add(follower['follower'])
+
+        for viewer_id in viewers:
+            pages_compared, differences = compare_engines(user_id, viewer_id, pages, limit)
+            compared += pages_compared
+            mismatches += len(differences)
+
+            for args, keys in differences:
+                print(f'MISMATCH user={user_id} viewer={viewer_id} args={args} keys={keys}')
+
+    print(f'Compared {compared} pages, {mismatches} mismatches')
+
+    if mismatches:
+        raise SystemExit(1)
+
+
+# serve_metrics_command()
+# Serves /metrics on METRICS_BIND when the app runs without gunicorn, e.g. under `flask run`.
+@commands_bp.cli.command('metrics-server')
+def serve_metrics_command():
+    print(f"Serving /metrics on {current_app.config['METRICS_BIND']}")
+    metrics_server(current_app.config['METRICS_BIND'], current_app.config['METRICS_DIR']).serve_forever()
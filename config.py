@@ -1,5 +1,6 @@
 # config.py
 import os
+import tempfile
 import certifi
 
 class Config(object):
@@ -7,8 +8,49 @@ class Config(object):
     CSRF_ENABLED = False
     MAX_CONTENT_LENGTH = 20 * 1000 * 1000 # 20MB
     SECRET_KEY = os.environ['SECRET_KEY']
-    MONGODB_SETTINGS = { 'host': f'{os.environ["MONGODB_HOST"]}{certifi.where()}' }
+    MONGODB_SETTINGS = {
+        'host': f'{os.environ["MONGODB_HOST"]}{certifi.where()}',
+        'connect': False, # The pool is opened by the first query, after gunicorn forks
+        'maxPoolSize': int(os.environ.get('MONGODB_MAX_POOL_SIZE', 20)), # At least the threads of one worker
+        'minPoolSize': int(os.environ.get('MONGODB_MIN_POOL_SIZE', 0)),
+        'maxIdleTimeMS': 60000,
+        'waitQueueTimeoutMS': 5000, # Fail a request instead of queueing forever on an exhausted pool
+        'connectTimeoutMS': 5000,
+        'serverSelectionTimeoutMS': 5000,
+        'socketTimeoutMS': 30000,
+        'compressors': os.environ.get('MONGODB_COMPRESSORS', 'zlib'),
+        'retryWrites': True
+    }
     JWT_SECRET_KEY = os.environ['JWT_SECRET_KEY']
+    JSON_SORT_KEYS = False
+    BCRYPT_LOG_ROUNDS = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+    PASSWORD_WORKERS = 2 # Concurrent bcrypt hashes per process
+    BACKGROUND_WORKERS = 4
+    FANOUT_MAX_FOLLOWERS = 5000 # Accounts with more followers are pulled on read
+    FANOUT_BACKFILL = 200 # Items copied into an inbox on follow
+    UPLOAD_WORKERS = 8
+    UPLOAD_SPOOL_DIR = os.environ.get('UPLOAD_SPOOL_DIR', os.path.join(tempfile.gettempdir(), 'hashtage-uploads'))
+    MEDIA_BACKEND = os.environ.get('MEDIA_BACKEND', 'cloudinary') # 'cloudinary' or 'local'
+    CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'local') # 'local', 'redis', 'fake-redis' or 'none'
+    CACHE_MAX_ENTRIES = 10000
+    CACHE_TTL = 60 # seconds
+    CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+    PROFILE_ENGINE = os.environ.get('PROFILE_ENGINE', 'python') # 'python' or 'aggregation' (one round trip, bypasses the card cache)
+    METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'hashtage-metrics')) # Per-process snapshots, summed by the metrics server
+    METRICS_BIND = os.environ.get('METRICS_BIND', '127.0.0.1:9100') # Internal address /metrics is served on, never the public port
+    METRICS_WRITE_SECONDS = 1
+    SLOW_REQUEST_MS = int(os.environ.get('SLOW_REQUEST_MS', 500)) # Requests slower than this are logged with their query counts
+    # Buffered deltas are per process: until they are flushed, other workers show the stored counts and compute
+    # a different ETag for the same page, so counts and 304s can differ between workers for up to COUNTER_FLUSH_SECONDS
+    COUNTER_FLUSH_SECONDS = float(os.environ.get('COUNTER_FLUSH_SECONDS', 0)) # Buffer like and retweet counters and write them every N seconds; 0 writes each change
+    EVENTS_BACKEND = os.environ.get('EVENTS_BACKEND', 'local') # 'local' (streams only see events of their own worker) or 'redis'
+    EVENTS_REDIS_URL = os.environ.get('EVENTS_REDIS_URL', os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/0'))
+    STREAM_HEARTBEAT = 15 # seconds between keepalive comments on /timeline/stream
+    STREAM_MAX_SECONDS = 300 # Streams are closed after this and the client reconnects, freeing the worker thread
+    STREAM_BUFFER = 100 # Events queued per stream before it is told to reset
+    STREAM_MAX_OPEN = int(os.environ.get('STREAM_MAX_OPEN', 4)) # Per process; keep below GUNICORN_THREADS so other requests still get a thread
+    STREAM_RETRY_AFTER = 30 # seconds, sent with the 503 when a process has STREAM_MAX_OPEN streams
+    MEDIA_LOCAL_ROOT = os.environ.get('MEDIA_LOCAL_ROOT', os.path.join(tempfile.gettempdir(), 'hashtage-media'))
 
 
 class ProductionConfig(Config):
@@ -0,0 +1,190 @@
+# batch.py
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from flask import Blueprint, request
+from flask_jwt_extended import jwt_required, get_jwt_identity
+from pymongo import UpdateOne
+from models.user import User
+from models.post import Post
+from models.retweet import Retweet
+from models.like import Like
+from models.follow import Follow
+from models.timeline import TimelineEntry
+from controllers.fanout import fan_out, follow_inbox, unfollow_inbox
+from controllers.cache import invalidate_posts
+from controllers.events import publish_item, publish_counters
+from controllers.counters import increment_counters
+
+batch_bp = Blueprint('batch_bp', __name__)
+
+MAX_OPERATIONS = 100
+
+# POST /batch applies a list of like, unlike, retweet, unretweet, follow and unfollow
+# operations for the viewer. Operations on the same target are collapsed to the last one.
+# Each relation is then written with one bulk upsert and one delete, and the counters with
+# one bulk $inc per collection. Upserting is idempotent, so liking a liked post or
+# unfollowing a user who is not followed reports no change instead of failing.
+
+# Operation -> (relation, adds the edge)
+OPERATIONS = {
+    'like': ('like', True),
+    'unlike': ('like', False),
+    'retweet': ('retweet', True),
+    'unretweet': ('retweet', False),
+    'follow': ('follow', True),
+    'unfollow': ('follow', False)
+}
+
+# Relation -> (document, viewer field, target field, counter on the target)
+RELATIONS = {
+    'like': (Like, 'user_id', 'post_id', 'likes_count'),
+    'retweet': (Retweet, 'user_id', 'post_id', 'retweets_count'),
+    'follow': (Follow, 'follower', 'following', 'followers_count')
+}
+
+
+# FUNCTION parseOperations()
+# Returns the results list, with errors filled in, and the last valid operation per target.
+def parseOperations(operations, viewer_id):
+    results = []
+    latest = {}
+
+    for index, operation in enumerate(operations):
+        op = operation.get('op') if isinstance(operation, dict) else None
+        target = operation.get('user_id' if op in ('follow', 'unfollow') else 'post_id') if op in OPERATIONS else None
+        results.append({ 'op': op, 'target': target })
+
+        if op not in OPERATIONS:
+            results[index].update({ 'ok': False, 'message': 'Unknown operation' })
+            continue
+
+        try:
+            target_id = ObjectId(target)
+        except (InvalidId, TypeError):
+            results[index].update({ 'ok': False, 'message': 'Invalid id' })
+            continue
+
+        if op in ('follow', 'unfollow') and target_id == viewer_id:
+            results[index].update({ 'ok': False, 'message': 'Cannot follow yourself' })
+            continue
+
+        relation, add = OPERATIONS[op]
+        previous = latest.get((relation, target_id))
+
+        if previous is not None:
+            results[previous[0]].update({ 'ok': True, 'changed': False, 'message': 'Superseded by a later operation' })
+
+        latest[(relation, target_id)] = (index, add)
+
+    return results, latest
+
+
+# FUNCTION applyRelation()
+# Writes the edges of one relation and returns the targets that were added and removed.
+def applyRelation(relation, viewer_id, wanted):
+    document, viewer_field, target_field = RELATIONS[relation][:3]
+    collection = document._get_collection()
+    viewer_db, target_db = document._fields[viewer_field].db_field, document._fields[target_field].db_field
+
+    adds = [target_id for target_id, add in wanted.items() if add]
+    removes = [target_id for target_id, add in wanted.items() if not add]
+
+    added = {}
+    removed = {}
+
+    if adds:
+        result = collection.bulk_write([UpdateOne({ viewer_db: viewer_id, target_db: target_id },
+            { '$setOnInsert': { viewer_db: viewer_id, target_db: target_id } }, upsert=True) for target_id in adds], ordered=False)
+        added = { adds[index]: edge_id for index, edge_id in result.upserted_ids.items() }
+
+    if removes:
+        existing = collection.find({ viewer_db: viewer_id, target_db: { '$in': removes } }, { target_db: 1 })
+        removed = { edge[target_db]: edge['_id'] for edge in existing }
+
+        if removed:
+            collection.delete_many({ '_id': { '$in': list(removed.values()) } })
+
+    return added, removed
+
+
+# batch()
+@batch_bp.route('/batch', methods=['POST'])
+@jwt_required()
+def batch():
+    data = request.get_json(silent=True)
+    operations = data.get('operations') if isinstance(data, dict) else None
+
+    if not isinstance(operations, list) or not 0 < len(operations) <= MAX_OPERATIONS:
+        return { 'batch': False, 'message': f'Send between 1 and {MAX_OPERATIONS} operations' }, 400
+
+    viewer_id = ObjectId(get_jwt_identity())
+    results, latest = parseOperations(operations, viewer_id)
+
+    # Targets that do not exist are reported and skipped
+    post_ids = [target_id for (relation, target_id) in latest if relation != 'follow']
+    user_ids = [target_id for (relation, target_id) in latest if relation == 'follow']
+    found = {
+        'post': { post['_id'] for post in Post.objects(id__in=post_ids, deleted__ne=True).only('id').as_pymongo() } if post_ids else set(),
+        'user': { user['_id'] for user in User.objects(id__in=user_ids).only('id').as_pymongo() } if user_ids else set()
+    }
+
+    wanted = { relation: {} for relation in RELATIONS }
+
+    for (relation, target_id), (index, add) in latest.items():
+        if target_id not in found['user' if relation == 'follow' else 'post']:
+            results[index].update({ 'ok': False, 'message': 'Post not found' if relation != 'follow' else 'User not found' })
+        else:
+            wanted[relation][target_id] = add
+
+    changes = { relation: applyRelation(relation, viewer_id, targets) for relation, targets in wanted.items() if targets }
+
+    # Counters: one $inc per post for likes and retweets together, through the counter
+    # buffer when it is on, and per user for follows
+    post_deltas = {}
+
+    for relation in ('like', 'retweet'):
+        added, removed = changes.get(relation, ({}, {}))
+        counter = RELATIONS[relation][3]
+
+        for target_id, sign in [(target_id, 1) for target_id in added] + [(target_id, -1) for target_id in removed]:
+            post_deltas.setdefault(target_id, {}).setdefault(counter, 0)
+            post_deltas[target_id][counter] += sign
+
+    if post_deltas:
+        increment_counters(post_deltas)
+        invalidate_posts(*post_deltas)
+
+        for post_id, deltas in post_deltas.items():
+            publish_counters(post_id, **deltas)
+
+    followed, unfollowed = changes.get('follow', ({}, {}))
+    user_deltas = { target_id: 1 for target_id in followed }
+    user_deltas.update({ target_id: -1 for target_id in unfollowed })
+
+    if user_deltas:
+        User._get_collection().bulk_write([UpdateOne({ '_id': user_id }, { '$inc': { 'followers_count': delta } }) for user_id, delta in user_deltas.items()]
+            + [UpdateOne({ '_id': viewer_id }, { '$inc': { 'following_count': sum(user_deltas.values()) } })], ordered=False)
+
+    # Inboxes: new retweets fan out, removed ones leave every inbox, follows backfill or clear
+    retweeted, unretweeted = changes.get('retweet', ({}, {}))
+
+    for post_id, retweet_id in retweeted.items():
+        fan_out(viewer_id, retweet_id, post_id, retweet_id)
+        publish_item('retweet', viewer_id, retweet_id, post_id)
+
+    if unretweeted:
+        TimelineEntry.objects(retweet_id__in=list(unretweeted.values())).delete()
+
+    for user_id in followed:
+        follow_inbox(viewer_id, user_id)
+
+    for user_id in unfollowed:
+        unfollow_inbox(viewer_id, user_id)
+
+    for (relation, target_id), (index, add) in latest.items():
+        if 'ok' not in results[index]:
+            added, removed = changes[relation]
+            results[index].update({ 'ok': True, 'changed': target_id in (added if add else removed) })
+
+    return { 'batch': True, 'results': results }, 200
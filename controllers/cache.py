@@ -0,0 +1,174 @@
+# cache.py
+
+import threading
+import time
+from collections import OrderedDict
+from bson import json_util
+from controllers.identity import forget
+
+# Cache for the viewer-independent part of post cards ('post:<id>') and for author summaries
+# ('user:<id>'). Entries expire after CACHE_TTL seconds and are dropped explicitly by the
+# handlers that change them, which also drops them from the request's identity map.
+# CACHE_BACKEND picks an in-process LRU ('local'), a shared Redis ('redis'), a local
+# stand-in for Redis ('fake-redis') or no caching at all ('none').
+
+cache = None
+
+
+# CLASS LocalCache
+# In-process LRU: the least recently used entry is evicted past max_entries.
+class LocalCache:
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_many(self, keys):
+        now = time.monotonic()
+        found = {}
+
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+
+                if entry is None:
+                    continue
+                if entry[0] < now:
+                    del self.entries[key]
+                    continue
+
+                self.entries.move_to_end(key)
+                found[key] = entry[1]
+
+        return found
+
+    def set_many(self, mapping):
+        expires = time.monotonic() + self.ttl
+
+        with self.lock:
+            for key, value in mapping.items():
+                self.entries[key] = (expires, value)
+                self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+
+# CLASS SharedCache
+# Cache shared by every worker through a Redis-like client. Eviction is left to the server
+# (maxmemory-policy allkeys-lru); values are stored as extended JSON.
+class SharedCache:
+    def __init__(self, client, ttl, prefix='hashtage:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get_many(self, keys):
+        keys = list(keys)
+
+        if not keys:
+            return {}
+
+        values = self.client.mget([self.prefix + key for key in keys])
+        return { key: json_util.loads(value) for key, value in zip(keys, values) if value is not None }
+
+    def set_many(self, mapping):
+        pipeline = self.client.pipeline()
+
+        for key, value in mapping.items():
+            pipeline.setex(self.prefix + key, self.ttl, json_util.dumps(value))
+
+        pipeline.execute()
+
+    def delete_many(self, keys):
+        keys = [self.prefix + key for key in keys]
+
+        if keys:
+            self.client.delete(*keys)
+
+
+# CLASS FakeRedis
+# Local stand-in for the subset of the Redis client SharedCache uses.
+class FakeRedis:
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def mget(self, keys):
+        now = time.monotonic()
+
+        with self.lock:
+            entries = [self.values.get(key) for key in keys]
+
+        return [entry[1] if entry is not None and entry[0] >= now else None for entry in entries]
+
+    def setex(self, key, ttl, value):
+        with self.lock:
+            self.values[key] = (time.monotonic() + ttl, value)
+
+    def delete(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.values.pop(key, None)
+
+    def pipeline(self):
+        return self
+
+    def execute(self):
+        return []
+
+
+# CLASS NoCache
+class NoCache:
+    def get_many(self, keys):
+        return {}
+
+    def set_many(self, mapping):
+        pass
+
+    def delete_many(self, keys):
+        pass
+
+
+# FUNCTION init_cache()
+def init_cache(app):
+    global cache
+
+    backend = app.config['CACHE_BACKEND']
+
+    if backend == 'local':
+        cache = LocalCache(app.config['CACHE_MAX_ENTRIES'], app.config['CACHE_TTL'])
+    elif backend == 'redis':
+        import redis
+        cache = SharedCache(redis.Redis.from_url(app.config['CACHE_REDIS_URL']), app.config['CACHE_TTL'])
+    elif backend == 'fake-redis':
+        cache = SharedCache(FakeRedis(), app.config['CACHE_TTL'])
+    else:
+        cache = NoCache()
+
+
+# FUNCTION get_cache()
+def get_cache():
+    return cache if cache is not None else NoCache()
+
+
+# FUNCTION invalidate_posts()
+def invalidate_posts(*post_ids):
+    post_ids = [post_id for post_id in post_ids if post_id is not None]
+    get_cache().delete_many([f'post:{post_id}' for post_id in post_ids])
+    forget('card', post_ids)
+    forget('state', post_ids)
+
+
+# FUNCTION invalidate_users()
+def invalidate_users(*user_ids):
+    user_ids = [user_id for user_id in user_ids if user_id is not None]
+    get_cache().delete_many([f'user:{user_id}' for user_id in user_ids])
+    forget('author', user_ids)
+    forget('version', user_ids)
@@ -0,0 +1,156 @@
+# counters.py
+
+import atexit
+import logging
+import threading
+import time
+from bson import ObjectId
+from flask import current_app
+from pymongo import UpdateOne
+from models.post import Post
+from controllers.cache import invalidate_posts
+
+# Like and retweet counters of posts. By default each change is written at once with $inc.
+# With COUNTER_FLUSH_SECONDS set, changes are summed per post in memory instead and written
+# by a background thread every COUNTER_FLUSH_SECONDS with one bulk $inc, so a viral post
+# takes one write per interval instead of one per like. Pending deltas are added to the
+# counts that cards, ETags and the aggregation profile read, and are flushed when the
+# process exits. Deltas held by a process that is killed are lost until the next
+# `flask reconcile-counters`. Pending deltas are only known to the process holding them, so
+# until a flush other workers serve the stored counts, with a different ETag.
+
+logger = logging.getLogger(__name__)
+
+pending = {}
+flushing = {}
+lock = threading.Lock()
+flush_lock = threading.Lock()
+flusher = None
+flushes = 0 # Flushes written by this process, see counter_flushes()
+
+
+# FUNCTION merge()
+# Adds { post_id: { field: delta } } into target.
+def merge(target, deltas):
+    for post_id, fields in deltas.items():
+        counters = target.setdefault(post_id, {})
+
+        for field, delta in fields.items():
+            counters[field] = counters.get(field, 0) + delta
+
+
+# FUNCTION write_counters()
+def write_counters(deltas):
+    updates = [UpdateOne({ '_id': post_id }, { '$inc': fields }) for post_id, fields in deltas.items() if any(fields.values())]
+
+    if updates:
+        Post._get_collection().bulk_write(updates, ordered=False)
+
+
+# FUNCTION increment_counters()
+# Applies { post_id: { field: delta } }, directly or through the buffer.
+def increment_counters(deltas):
+    deltas = { ObjectId(str(post_id)): fields for post_id, fields in deltas.items() }
+    interval = current_app.config['COUNTER_FLUSH_SECONDS']
+
+    if not interval:
+        write_counters(deltas)
+        return
+
+    start_flusher(interval)
+
+    with lock:
+        merge(pending, deltas)
+
+
+# FUNCTION pending_counters()
+# Returns the deltas not yet written for the given posts, including a flush in progress.
+def pending_counters(post_ids):
+    with lock:
+        if not pending and not flushing:
+            return {}
+
+        deltas = {}
+
+        for post_id in post_ids:
+            post_id = ObjectId(str(post_id))
+            merge(deltas, { post_id: flushing.get(post_id, {}) })
+            merge(deltas, { post_id: pending.get(post_id, {}) })
+
+    return { post_id: fields for post_id, fields in deltas.items() if fields }
+
+
+# FUNCTION apply_pending()
+# Adds the pending deltas to the counters of card-like dicts, which have an 'id'.
+def apply_pending(cards):
+    deltas = pending_counters([card['id'] for card in cards])
+
+    for card in cards:
+        for field, delta in deltas.get(ObjectId(card['id']), {}).items():
+            card[field] = card.get(field, 0) + delta
+
+    return cards
+
+
+# FUNCTION counter_flushes()
+# Returns how many flushes this process has written. A reader that loaded cards from the
+# database compares it before and after caching them: if a flush ran in between, the cards
+# may hold the counts from before it and are dropped from the cache again.
+def counter_flushes():
+    return flushes
+
+
+# FUNCTION flush_counters()
+# Writes the buffered deltas with one bulk $inc. On failure they go back into the buffer.
+def flush_counters():
+    global pending, flushing, flushes
+
+    with flush_lock:
+        with lock:
+            if not pending:
+                return
+
+            flushing, pending = pending, {}
+
+        try:
+            write_counters(flushing)
+        except Exception:
+            with lock:
+                merge(pending, flushing)
+                flushing = {}
+            raise
+
+        # Cleared as soon as the $inc is stored, so readers do not add the deltas twice
+        with lock:
+            written, flushing = flushing, {}
+            flushes += 1
+
+        invalidate_posts(*written)
+
+
+# FUNCTION run_flusher()
+def run_flusher(interval):
+    while True:
+        time.sleep(interval)
+
+        try:
+            flush_counters()
+        except Exception:
+            logger.error('Counter flush failed', exc_info=True)
+
+
+# FUNCTION start_flusher()
+# Started on first use, so it runs in the gunicorn worker and not in the preloading master.
+def start_flusher(interval):
+    global flusher
+
+    if flusher is not None:
+        return
+
+    with lock:
+        if flusher is not None:
+            return
+
+        flusher = threading.Thread(target=run_flusher, args=(interval,), name='counters', daemon=True)
+        flusher.start()
+        atexit.register(flush_counters)
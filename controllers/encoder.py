@@ -0,0 +1,23 @@
+# encoder.py
+
+from datetime import date
+from bson import ObjectId, DBRef
+from flask.json import JSONEncoder as FlaskJSONEncoder
+from werkzeug.http import http_date
+
+# Responses are built from plain dicts, so the only values the encoder has to handle are the
+# ids and dates read from Mongo. They are checked first, before the document and queryset
+# fallbacks flask_mongoengine wraps around this class. A reference is encoded as its id.
+
+
+# CLASS JSONEncoder
+class JSONEncoder(FlaskJSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, ObjectId):
+            return str(obj)
+        if isinstance(obj, DBRef):
+            return str(obj.id)
+        if isinstance(obj, date):
+            return http_date(obj)
+
+        return super().default(obj)
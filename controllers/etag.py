@@ -0,0 +1,65 @@
+# etag.py
+
+import hashlib
+from bson import json_util
+from flask import request
+from controllers.hydrator import to_object_ids, viewer_state, load_states, load_user_versions, POST_STATE_FIELDS
+from controllers.counters import pending_counters
+
+# GET routes compute a version token for their page from the ids on it, the counters of
+# every post, the version of their authors and the viewer's flags, all read with small
+# projections. A client that sends the token back in If-None-Match gets a 304 before the
+# page is hydrated. The text of a post never changes, and its images are set along with
+# media_status, so these fields cover everything a card shows. The projections stay in the
+# request's identity map, and the hydrator checks its cached cards and authors against
+# them, so the body always matches the token.
+
+POST_VERSION_FIELDS = POST_STATE_FIELDS
+
+
+# FUNCTION post_versions()
+def post_versions(post_ids, viewer_id):
+    post_ids = to_object_ids(post_ids)
+
+    if not post_ids:
+        return []
+
+    posts = list(load_states(post_ids).values())
+    liked, retweeted = viewer_state(viewer_id, post_ids)
+    deltas = pending_counters(post_ids)
+
+    return [
+        sorted([[post['_id']] + [post.get(field, 0) + deltas.get(post['_id'], {}).get(field, 0) if field.endswith('_count') else post.get(field)
+            for field in POST_VERSION_FIELDS] for post in posts]),
+        user_versions(post['author'] for post in posts),
+        sorted(liked),
+        sorted(retweeted)
+    ]
+
+
+# FUNCTION user_versions()
+def user_versions(user_ids):
+    user_ids = to_object_ids(set(user_ids))
+
+    if not user_ids:
+        return []
+
+    return sorted([user_id, version] for user_id, version in load_user_versions(user_ids).items())
+
+
+# FUNCTION make_etag()
+def make_etag(*parts):
+    return hashlib.sha1(json_util.dumps([request.full_path, parts]).encode('utf-8')).hexdigest()
+
+
+# FUNCTION not_modified()
+def not_modified(etag):
+    return etag in request.if_none_match
+
+
+# FUNCTION etag_response()
+def etag_response(etag, body=None, status=200):
+    if body is None:
+        return '', 304, { 'ETag': f'"{etag}"' }
+
+    return body, status, { 'ETag': f'"{etag}"' }
@@ -0,0 +1,173 @@
+# events.py
+
+import json
+import queue
+import threading
+import time
+from collections import defaultdict
+from bson import json_util
+from controllers.pagination import encode_cursor
+
+# Publish/subscribe for live updates. Handlers publish new posts and retweets on the
+# channel of their author ('user:<id>') and counter deltas on the channel of the post
+# ('post:<id>'); /timeline/stream subscribes to the channels a viewer cares about.
+# EVENTS_BACKEND picks an in-process broker ('local'), which only reaches streams served by
+# the same worker, or Redis pub/sub ('redis'), which reaches every worker.
+
+broker = None
+
+
+# CLASS LocalSubscription
+# Events are queued per subscriber. A subscriber that falls STREAM_BUFFER events behind
+# gets a single 'reset' event instead of the ones it missed.
+class LocalSubscription:
+    def __init__(self, broker, size):
+        self.broker = broker
+        self.queue = queue.Queue(maxsize=size)
+        self.channels = set()
+        self.overflowed = False
+
+    def add(self, channels):
+        channels = set(channels) - self.channels
+        self.channels |= channels
+
+        with self.broker.lock:
+            for channel in channels:
+                self.broker.subscribers[channel].add(self)
+
+    def put(self, channel, event):
+        try:
+            self.queue.put_nowait((channel, event))
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout):
+        if self.overflowed:
+            self.overflowed = False
+            return None, { 'type': 'reset' }
+
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        with self.broker.lock:
+            for channel in self.channels:
+                self.broker.subscribers[channel].discard(self)
+
+                if not self.broker.subscribers[channel]:
+                    del self.broker.subscribers[channel]
+
+
+# CLASS LocalBroker
+class LocalBroker:
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.subscribers = defaultdict(set)
+        self.lock = threading.Lock()
+
+    def publish(self, channel, event):
+        with self.lock:
+            subscribers = list(self.subscribers.get(channel, ()))
+
+        for subscriber in subscribers:
+            subscriber.put(channel, event)
+
+    def subscribe(self):
+        return LocalSubscription(self, self.buffer)
+
+
+# CLASS RedisSubscription
+class RedisSubscription:
+    def __init__(self, pubsub, prefix):
+        self.pubsub = pubsub
+        self.prefix = prefix
+        self.channels = set()
+
+    def add(self, channels):
+        channels = set(channels) - self.channels
+
+        if channels:
+            self.channels |= channels
+            self.pubsub.subscribe(*[self.prefix + channel for channel in channels])
+
+    def get(self, timeout):
+        # Without a subscription the client returns at once instead of waiting
+        if not self.channels:
+            time.sleep(timeout)
+            return None
+
+        message = self.pubsub.get_message(ignore_subscribe_messages=True, timeout=timeout)
+
+        if message is None:
+            return None
+
+        return message['channel'].decode()[len(self.prefix):], json_util.loads(message['data'])
+
+    def close(self):
+        self.pubsub.close()
+
+
+# CLASS RedisBroker
+class RedisBroker:
+    def __init__(self, client, prefix='hashtage:events:'):
+        self.client = client
+        self.prefix = prefix
+
+    def publish(self, channel, event):
+        self.client.publish(self.prefix + channel, json_util.dumps(event))
+
+    def subscribe(self):
+        return RedisSubscription(self.client.pubsub(), self.prefix)
+
+
+# FUNCTION init_events()
+def init_events(app):
+    global broker
+
+    if app.config['EVENTS_BACKEND'] == 'redis':
+        import redis
+        broker = RedisBroker(redis.Redis.from_url(app.config['EVENTS_REDIS_URL']))
+    else:
+        broker = LocalBroker(app.config['STREAM_BUFFER'])
+
+
+# FUNCTION get_broker()
+def get_broker():
+    if broker is None:
+        raise RuntimeError('init_events() has not been called')
+
+    return broker
+
+
+# FUNCTION publish_item()
+# A new post or retweet, sent to the followers of its author. `cursor` is the item's
+# position in the timeline, usable as `?since=` after reconnecting.
+def publish_item(kind, actor_id, item_id, post_id):
+    get_broker().publish(f'user:{actor_id}', {
+        'type': kind,
+        'id': str(item_id),
+        'post_id': str(post_id),
+        'author': str(actor_id),
+        'cursor': encode_cursor(item_id)
+    })
+
+
+# FUNCTION publish_counters()
+# Counter changes of a post, as deltas, e.g. publish_counters(post_id, likes_count=1).
+def publish_counters(post_id, **deltas):
+    get_broker().publish(f'post:{post_id}', { 'type': 'counters', 'post_id': str(post_id), **deltas })
+
+
+# FUNCTION format_event()
+# One Server-Sent Events message.
+def format_event(event):
+    lines = [f"event: {event['type']}"]
+
+    if 'cursor' in event:
+        lines.append(f"id: {event['cursor']}")
+
+    lines.append(f'data: {json.dumps(event)}')
+
+    return '\n'.join(lines) + '\n\n'
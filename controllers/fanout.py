@@ -0,0 +1,103 @@
+# fanout.py
+
+from bson import ObjectId
+from flask import current_app
+from pymongo.errors import BulkWriteError
+from models.user import User
+from models.follow import Follow
+from models.post import Post
+from models.retweet import Retweet
+from models.timeline import TimelineEntry
+from controllers.jobs import submit
+
+# Posts and retweets are copied into the timeline inbox of every follower of their author
+# by the background job pool, so /timeline is a single range read on the reader's inbox.
+# Accounts with more than FANOUT_MAX_FOLLOWERS followers are skipped here and pulled
+# on read instead.
+
+BATCH_SIZE = 1000
+
+
+# FUNCTION is_pulled()
+def is_pulled(user_id):
+    return follower_counts([user_id]).get(user_id, 0) > current_app.config['FANOUT_MAX_FOLLOWERS']
+
+
+# FUNCTION follower_counts()
+def follower_counts(user_ids):
+    users = User.objects(id__in=user_ids).only('followers_count').as_pymongo()
+    return { user['_id']: user.get('followers_count', 0) for user in users }
+
+
+# FUNCTION pulled_accounts()
+# The followed accounts too large to fan out, whose items are merged into timelines on read.
+def pulled_accounts(user_ids):
+    limit = current_app.config['FANOUT_MAX_FOLLOWERS']
+    return [user_id for user_id, count in follower_counts(user_ids).items() if count > limit]
+
+
+# FUNCTION entry()
+def entry(owner_id, actor_id, item_id, post_id, retweet_id=None):
+    return {
+        'owner': owner_id,
+        'actor': actor_id,
+        'item_id': item_id,
+        'post_id': post_id,
+        'retweet_id': retweet_id
+    }
+
+
+# FUNCTION insert_entries()
+def insert_entries(entries):
+    for start in range(0, len(entries), BATCH_SIZE):
+        try:
+            TimelineEntry._get_collection().insert_many(entries[start:start + BATCH_SIZE], ordered=False)
+        except BulkWriteError as error:
+            # Entries that are already in an inbox are skipped
+            if any(write_error['code'] != 11000 for write_error in error.details['writeErrors']):
+                raise
+
+
+# FUNCTION push_to_followers()
+def push_to_followers(actor_id, item_id, post_id, retweet_id=None):
+    follows = Follow.objects(following=actor_id).only('follower').as_pymongo()
+    insert_entries([entry(follow['follower'], actor_id, item_id, post_id, retweet_id) for follow in follows])
+
+
+# FUNCTION fan_out()
+# Schedules the inbox writes for a new post or retweet unless its author is pulled on read.
+def fan_out(actor_id, item_id, post_id, retweet_id=None):
+    actor_id = ObjectId(str(actor_id))
+
+    if not is_pulled(actor_id):
+        submit(push_to_followers, actor_id, item_id, post_id, retweet_id)
+
+
+# FUNCTION backfill_inbox()
+# Copies the latest items of a newly followed account into the follower's inbox.
+def backfill_inbox(owner_id, actor_id, limit):
+    posts = Post.objects(author=actor_id, parent=None).order_by('-id').limit(limit).only('id')
+    retweets = Retweet.objects(user_id=actor_id).order_by('-id').limit(limit).no_dereference()
+
+    entries = [entry(owner_id, actor_id, post.id, post.id) for post in posts]
+    entries += [entry(owner_id, actor_id, retweet.id, retweet.post_id.id, retweet.id) for retweet in retweets]
+
+    insert_entries(entries)
+
+
+# FUNCTION follow_inbox()
+def follow_inbox(owner_id, actor_id):
+    owner_id, actor_id = ObjectId(str(owner_id)), ObjectId(str(actor_id))
+
+    if not is_pulled(actor_id):
+        submit(backfill_inbox, owner_id, actor_id, current_app.config['FANOUT_BACKFILL'])
+
+
+# FUNCTION clear_inbox()
+def clear_inbox(owner_id, actor_id):
+    TimelineEntry.objects(owner=owner_id, actor=actor_id).delete()
+
+
+# FUNCTION unfollow_inbox()
+def unfollow_inbox(owner_id, actor_id):
+    submit(clear_inbox, ObjectId(str(owner_id)), ObjectId(str(actor_id)))
@@ -0,0 +1,225 @@
+# hydrator.py
+
+from bson import ObjectId
+from models.user import User
+from models.post import Post
+from models.retweet import Retweet
+from models.like import Like
+from controllers.cache import get_cache
+from controllers.identity import lookup, peek
+from controllers.counters import apply_pending, counter_flushes
+
+# Every feed builds the same post card. Instead of querying viewer state and authors
+# once per post, the helpers below load them for the whole page in a fixed number of
+# bulk queries. Counts and image urls are read from the fields stored on Post, and the
+# parts of a card that do not depend on the viewer are cached. Each worker has its own
+# cache, so a cached card is only trusted while it agrees with the state of the post read
+# for the page's ETag; a change made through another worker reloads it.
+
+# Fields a post changes after it is written, with their defaults -> stored on the card as-is
+CARD_STATE = { 'likes_count': 0, 'retweets_count': 0, 'comments_count': 0, 'media_status': 'ready' }
+POST_STATE_FIELDS = ('author', 'deleted') + tuple(CARD_STATE)
+
+
+# FUNCTION to_object_ids()
+def to_object_ids(ids):
+    return [id if isinstance(id, ObjectId) else ObjectId(str(id)) for id in ids]
+
+
+# FUNCTION load_authors()
+# Returns the summaries of the given users, read through the request's identity map and the cache.
+def load_authors(user_ids):
+    return lookup('author', to_object_ids(user_ids), fetch_authors)
+
+
+# FUNCTION load_user_versions()
+# Returns { user_id: version } for the given users.
+def load_user_versions(user_ids):
+    return lookup('version', to_object_ids(user_ids), lambda missing:
+        { user['_id']: user.get('version', 0) for user in User.objects(id__in=missing).only('version').as_pymongo() })
+
+
+# FUNCTION fetch_authors()
+# Cached summaries carry the version of the user, checked like the state of cached cards.
+def fetch_authors(user_ids):
+    cached = get_cache().get_many([f'user:{user_id}' for user_id in user_ids])
+    versions = peek('version', user_ids)
+
+    authors = { user_id: cached[f'user:{user_id}'] for user_id in user_ids
+        if f'user:{user_id}' in cached and versions.get(user_id, cached[f'user:{user_id}'].get('version')) == cached[f'user:{user_id}'].get('version') }
+    missing = [user_id for user_id in user_ids if user_id not in authors]
+    stale = [f'user:{user_id}' for user_id in missing if f'user:{user_id}' in cached]
+
+    if stale:
+        get_cache().delete_many(stale)
+
+    if missing:
+        loaded = { user.id: {
+            'id': str(user.id),
+            'full_name': user.full_name,
+            'username': user.username,
+            'version': user.version
+        } for user in User.objects(id__in=missing).only('full_name', 'username', 'version') }
+
+        get_cache().set_many({ f'user:{user_id}': author for user_id, author in loaded.items() })
+        authors.update(loaded)
+
+    return { user_id: { field: value for field, value in author.items() if field != 'version' } for user_id, author in authors.items() }
+
+
+# FUNCTION load_author()
+def load_author(user_id):
+    return load_authors([user_id]).get(to_object_ids([user_id])[0])
+
+
+# FUNCTION load_cards()
+# Returns the viewer-independent part of the cards of the given posts, read through the
+# request's identity map and the cache.
+def load_cards(post_ids):
+    return lookup('card', to_object_ids(post_ids), fetch_cards)
+
+
+# FUNCTION load_states()
+# Reads the author, counters, media status and tombstone of posts with a small projection.
+def load_states(post_ids):
+    return lookup('state', to_object_ids(post_ids), lambda missing:
+        { post['_id']: post for post in Post.objects(id__in=missing).only(*POST_STATE_FIELDS).as_pymongo() })
+
+
+# FUNCTION is_current()
+# Whether a cached card agrees with the state of its post read in this request. `states`
+# comes from peek(): a post that was not read is trusted, one that was read and is gone or
+# tombstoned is not.
+def is_current(card, post_id, states):
+    if post_id not in states:
+        return True
+
+    state = states[post_id]
+
+    if state is None or state.get('deleted'):
+        return False
+
+    return all(card.get(field) == state.get(field, default) for field, default in CARD_STATE.items())
+
+
+# FUNCTION fetch_cards()
+def fetch_cards(post_ids):
+    cached = get_cache().get_many([f'post:{post_id}' for post_id in post_ids])
+    states = peek('state', post_ids)
+
+    cards = { post_id: cached[f'post:{post_id}'] for post_id in post_ids
+        if f'post:{post_id}' in cached and is_current(cached[f'post:{post_id}'], post_id, states) }
+    missing = [post_id for post_id in post_ids if post_id not in cards]
+    stale = [f'post:{post_id}' for post_id in missing if f'post:{post_id}' in cached]
+
+    if stale:
+        get_cache().delete_many(stale)
+
+    if missing:
+        flushes = counter_flushes()
+        loaded = { post.id: {
+            'id': str(post.id),
+            'author_id': str(post.author.id),
+            'text': post.text,
+            'date': post.date,
+            'images': [image.url for image in post.images],
+            'media_status': post.media_status,
+            'parent': str(post.parent.id) if post.parent is not None else None,
+            'retweets_count': post.retweets_count,
+            'comments_count': post.comments_count,
+            'likes_count': post.likes_count
+        } for post in Post.objects(id__in=missing, deleted__ne=True).no_dereference() }
+
+        get_cache().set_many({ f'post:{post_id}': card for post_id, card in loaded.items() })
+
+        # The flush's own invalidation may have run before the write above
+        if counter_flushes() != flushes:
+            get_cache().delete_many([f'post:{post_id}' for post_id in loaded])
+
+        cards.update(loaded)
+
+    return cards
+
+
+# FUNCTION viewer_state()
+# Returns the ids of the posts on the page that the viewer liked and retweeted. Each
+# collection is queried once on its (user_id, post_id) index, so the cost depends on
+# the size of the page and not on how many likes or retweets the posts have. The flags are
+# kept in the identity map, so the ETag and the body of a page share one read.
+def viewer_state(viewer_id, post_ids):
+    post_ids = to_object_ids(post_ids)
+
+    if viewer_id is None or not post_ids:
+        return set(), set()
+
+    flags = lookup(f'viewer:{viewer_id}', post_ids, lambda missing: load_flags(viewer_id, missing))
+
+    return { post_id for post_id, (liked, retweeted) in flags.items() if liked }, { post_id for post_id, (liked, retweeted) in flags.items() if retweeted }
+
+
+# FUNCTION load_flags()
+# Returns { post_id: (liked, retweeted) } for the viewer.
+def load_flags(viewer_id, post_ids):
+    liked = { like['post_id'] for like in Like.objects(user_id=viewer_id, post_id__in=post_ids).only('post_id').as_pymongo() }
+    retweeted = { retweet['post_id'] for retweet in Retweet.objects(user_id=viewer_id, post_id__in=post_ids).only('post_id').as_pymongo() }
+
+    return { post_id: (post_id in liked, post_id in retweeted) for post_id in post_ids }
+
+
+# FUNCTION hydrate_posts()
+# The cached part of each card is copied and the viewer's flags are overlaid on it.
+def hydrate_posts(post_ids, viewer_id):
+    post_ids = to_object_ids(post_ids)
+
+    if not post_ids:
+        return []
+
+    posts = load_cards(list(dict.fromkeys(post_ids)))
+    authors = load_authors(ObjectId(post['author_id']) for post in posts.values())
+    liked, retweeted = viewer_state(viewer_id, list(posts))
+
+    cards = []
+
+    for post_id in post_ids:
+        post = posts.get(post_id)
+
+        if post is None:
+            continue
+
+        card = dict(post)
+        author_id = card.pop('author_id')
+
+        card.update({
+            'author': authors.get(ObjectId(author_id)),
+            'didRetweet': post_id in retweeted,
+            'didLike': post_id in liked,
+            'isAuthor': author_id == str(viewer_id)
+        })
+        cards.append(card)
+
+    return apply_pending(cards)
+
+
+# FUNCTION hydrate_shares()
+# Builds the cards for retweets or likes: the shared post is hydrated along with the rest
+# of the page and the sharing user is summarized.
+def hydrate_shares(shares, viewer_id):
+    cards = { card['id']: card for card in hydrate_posts([share.post_id.id for share in shares], viewer_id) }
+    users = load_authors(share.user_id.id for share in shares)
+
+    items = []
+
+    for share in shares:
+        card = cards.get(str(share.post_id.id))
+        user = users.get(share.user_id.id)
+
+        if card is None or user is None:
+            continue
+
+        items.append({
+            'id': str(share.id),
+            'user_id': user,
+            'post_id': card
+        })
+
+    return items
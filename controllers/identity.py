@@ -0,0 +1,72 @@
+# identity.py
+
+from bson import DBRef, ObjectId
+from flask import g, has_request_context
+from controllers.metrics import current_stats
+
+# Request-scoped identity map. Everything a request loads by id (documents, author summaries,
+# post cards) is kept on flask.g under its kind and id, so a user or post referenced from
+# several places on a page is loaded once, with one `__in` query per kind for all the ids
+# still missing. Hits and misses are counted in the request metrics. Outside a request, e.g.
+# in background jobs, nothing is kept and every lookup goes to the loader.
+
+
+# FUNCTION lookup()
+# Returns { id: value } for the ids found, calling loader(missing_ids) once for the rest.
+def lookup(kind, ids, loader):
+    ids = list(dict.fromkeys(ids))
+    entries = g.setdefault('identity_map', {}) if has_request_context() else {}
+    found = { id: entries[(kind, id)] for id in ids if (kind, id) in entries }
+    missing = [id for id in ids if (kind, id) not in entries]
+
+    stats = current_stats()
+
+    if stats is not None:
+        stats.identity_hits += len(found)
+        stats.identity_misses += len(missing)
+
+    if missing:
+        loaded = loader(missing)
+        found.update(loaded)
+
+        # Ids that do not exist are remembered too, so they are not queried again
+        entries.update({ (kind, id): loaded.get(id) for id in missing })
+
+    return { id: value for id, value in found.items() if value is not None }
+
+
+# FUNCTION peek()
+# Returns { id: value } for the ids already in the map, without loading the others. Ids that
+# were loaded but do not exist are returned with None, unlike in lookup().
+def peek(kind, ids):
+    entries = g.get('identity_map', {}) if has_request_context() else {}
+    return { id: entries[(kind, id)] for id in ids if (kind, id) in entries }
+
+
+# FUNCTION forget()
+# Drops entries a request changed, so later lookups in the same request reload them.
+def forget(kind, ids):
+    if has_request_context():
+        entries = g.setdefault('identity_map', {})
+
+        for id in ids:
+            entries.pop((kind, ObjectId(str(id))), None)
+
+
+# FUNCTION load_documents()
+# Loads documents by id without dereferencing their references.
+def load_documents(document, ids):
+    return lookup(document.__name__, [ObjectId(str(id)) for id in ids], lambda missing: { item.id: item for item in document.objects(id__in=missing).no_dereference() })
+
+
+# FUNCTION reference_id()
+# Returns the id stored in a reference field without loading the referenced document.
+def reference_id(document, field):
+    value = document._data.get(field)
+
+    if value is None or isinstance(value, ObjectId):
+        return value
+    if isinstance(value, DBRef):
+        return value.id
+
+    return value.pk if hasattr(value, 'pk') else ObjectId(str(value))
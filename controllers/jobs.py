@@ -0,0 +1,46 @@
+# jobs.py
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+
+# Shared pool for the work that runs after a response is sent (timeline fan-out, cascade
+# deletes). Failures are logged since nobody is waiting on the result.
+
+executor = None
+executor_lock = threading.Lock()
+logger = logging.getLogger(__name__)
+
+
+# FUNCTION log_failure()
+def log_failure(future):
+    if future.exception() is not None:
+        logger.error('Background job failed', exc_info=future.exception())
+
+
+# FUNCTION submit()
+def submit(function, *args):
+    global executor
+
+    if executor is None:
+        with executor_lock:
+            if executor is None:
+                executor = ThreadPoolExecutor(max_workers=current_app.config['BACKGROUND_WORKERS'], thread_name_prefix='jobs')
+
+    executor.submit(function, *args).add_done_callback(log_failure)
+
+
+# FUNCTION with_retries()
+# Calls an external service, retrying with exponential backoff before giving up.
+def with_retries(function, *args, attempts=3, delay=0.5, **kwargs):
+    for attempt in range(attempts):
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            if attempt == attempts - 1:
+                raise
+
+            logger.warning('Retrying %r after failure', function, exc_info=True)
+            time.sleep(delay * 2 ** attempt)
@@ -0,0 +1,157 @@
+# media.py
+
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from flask import current_app
+from werkzeug.utils import secure_filename
+from cloudinary import uploader, api
+from models.post import Post, Image
+from controllers.jobs import with_retries
+from controllers.cache import invalidate_posts
+from controllers.metrics import cloudinary_call
+from controllers.identity import reference_id
+
+# Images are spooled to local disk in the request and the post is returned with a pending
+# media_status. The files are uploaded in parallel on their own pool, and when the last one
+# finishes the results are stored on the post and it is marked ready, or failed if an upload
+# still failed after retries. Nothing waits on the uploads, so the shared background pool is
+# never held by them. Posts left pending by a worker that died are marked failed by
+# `flask sweep-uploads`. MEDIA_BACKEND picks where files go: Cloudinary, or a local directory
+# that stands in for it so the whole pipeline runs offline.
+
+upload_executor = None
+upload_executor_lock = threading.Lock()
+logger = logging.getLogger(__name__)
+
+
+# CLASS CloudinaryMedia
+class CloudinaryMedia:
+    def upload(self, path, folder, public_id):
+        return cloudinary_call(uploader.upload_image, path, folder=folder, public_id=public_id).metadata
+
+    def delete_resources(self, public_ids):
+        cloudinary_call(api.delete_resources, public_ids)
+
+    def delete_resources_by_prefix(self, prefix):
+        cloudinary_call(api.delete_resources_by_prefix, prefix)
+
+    def delete_folder(self, folder):
+        cloudinary_call(api.delete_folder, folder)
+
+
+# CLASS LocalMedia
+# Stores uploads under a local directory and answers like Cloudinary's upload API.
+class LocalMedia:
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def upload(self, path, folder, public_id):
+        target = self.root / folder / (public_id + Path(path).suffix)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(path, target)
+
+        return {
+            'public_id': f'{folder}/{public_id}',
+            'secure_url': target.resolve().as_uri(),
+            'width': None,
+            'height': None,
+            'bytes': target.stat().st_size
+        }
+
+    def delete_resources(self, public_ids):
+        for public_id in public_ids:
+            for path in (self.root / public_id).parent.glob(Path(public_id).name + '.*'):
+                path.unlink()
+
+    def delete_resources_by_prefix(self, prefix):
+        shutil.rmtree(self.root / prefix, ignore_errors=True)
+
+    def delete_folder(self, folder):
+        shutil.rmtree(self.root / folder, ignore_errors=True)
+
+
+# FUNCTION media_backend()
+def media_backend():
+    if current_app.config['MEDIA_BACKEND'] == 'local':
+        return LocalMedia(current_app.config['MEDIA_LOCAL_ROOT'])
+
+    return CloudinaryMedia()
+
+
+# FUNCTION spool_images()
+# Saves the request files to the spool directory and returns their paths in upload order.
+def spool_images(post, files):
+    spool = Path(current_app.config['UPLOAD_SPOOL_DIR']) / str(post.pk)
+    spool.mkdir(parents=True, exist_ok=True)
+
+    paths = []
+
+    for index, image in enumerate(files, start=1):
+        path = spool / f'{index}-{secure_filename(image.filename) or uuid.uuid4().hex}'
+        image.save(path)
+        paths.append(str(path))
+
+    return paths
+
+
+# FUNCTION finish_upload()
+# Runs once every upload of a post is done.
+def finish_upload(post_id, paths, futures):
+    try:
+        results = [future.result() for future in futures]
+
+        images = [Image(url=result['secure_url'], public_id=result['public_id'], width=result.get('width'), height=result.get('height'),
+        bytes=result.get('bytes')) for result in results]
+
+        Post.objects(id=post_id).update_one(set__images=images, set__media_status='ready')
+    except Exception:
+        logger.error('Upload of post %s failed', post_id, exc_info=True)
+        Post.objects(id=post_id).update_one(set__media_status='failed')
+    finally:
+        invalidate_posts(post_id)
+        shutil.rmtree(os.path.dirname(paths[0]), ignore_errors=True)
+
+
+# FUNCTION process_upload()
+# Submits the files of a post to the upload pool; the last one to finish calls finish_upload().
+def process_upload(post_id, folder, paths, backend, workers):
+    global upload_executor
+
+    if upload_executor is None:
+        with upload_executor_lock:
+            if upload_executor is None:
+                upload_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='uploads')
+
+    futures = [upload_executor.submit(with_retries, backend.upload, path, folder, f'{time.time()}-{index}')
+        for index, path in enumerate(paths, start=1)]
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(future):
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+
+        if last:
+            finish_upload(post_id, paths, futures)
+
+    for future in futures:
+        future.add_done_callback(done)
+
+
+# FUNCTION upload_images()
+# Spools the images of a new post and queues their upload.
+def upload_images(post, files):
+    folder = f'hashtage/{str(reference_id(post, "author"))}/{str(post.pk)}'
+    paths = spool_images(post, files)
+
+    post.update(img_path=folder, media_status='pending')
+    post.reload()
+
+    process_upload(post.pk, folder, paths, media_backend(), current_app.config['UPLOAD_WORKERS'])
@@ -0,0 +1,326 @@
+# metrics.py
+
+import atexit
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from flask import current_app, g, has_request_context, request
+from pymongo import monitoring
+
+# Each request collects the Mongo commands it ran, through pymongo command monitoring, the
+# Cloudinary calls it made, through cloudinary_call(), and the hits and misses of its
+# identity map. When the response goes out the totals feed per-route histograms served on
+# /metrics in the Prometheus text format, are logged when the request was slower than
+# SLOW_REQUEST_MS, and are added as X- headers in debug mode. Commands and calls made
+# outside a request (background jobs) only count towards the process-wide totals.
+#
+# Each process writes a snapshot of its histograms to METRICS_DIR at most every
+# METRICS_WRITE_SECONDS and when it exits. /metrics is not served by the app: the gunicorn
+# master serves it on METRICS_BIND, an internal address, summing the snapshots of every
+# worker, including the ones that have exited so the counts never go backwards. Outside
+# gunicorn, `flask metrics-server` does the same.
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+listener = None
+snapshot_dir = None
+snapshot_written = 0.0
+
+
+# CLASS Histogram
+# A set of Prometheus histograms sharing buckets, one per label set.
+class Histogram:
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, labels, value):
+        key = tuple(sorted(labels.items()))
+
+        with self.lock:
+            counts, total = self.series.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.series[key] = (counts, total + value)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+
+        with self.lock:
+            series = sorted(self.series.items())
+
+        for key, (counts, total) in series:
+            labels = ','.join(f'{name}="{value}"' for name, value in key)
+            cumulative = 0
+
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+
+            lines.append(f'{self.name}_sum{{{labels}}} {total}')
+            lines.append(f'{self.name}_count{{{labels}}} {cumulative}')
+
+        return lines
+
+    def snapshot(self):
+        with self.lock:
+            return [[list(key), counts, total] for key, (counts, total) in self.series.items()]
+
+    def merge(self, snapshot):
+        with self.lock:
+            for key, counts, total in snapshot:
+                key = tuple(tuple(pair) for pair in key)
+                merged, merged_total = self.series.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+                self.series[key] = ([a + b for a, b in zip(merged, counts)], merged_total + total)
+
+
+request_duration = Histogram('hashtage_request_duration_seconds', 'Request latency by route', DURATION_BUCKETS)
+request_mongo_commands = Histogram('hashtage_request_mongo_commands', 'Mongo commands run per request by route', COUNT_BUCKETS)
+request_mongo_duration = Histogram('hashtage_request_mongo_duration_seconds', 'Time spent in Mongo per request by route', DURATION_BUCKETS)
+mongo_command_duration = Histogram('hashtage_mongo_command_duration_seconds', 'Mongo command latency by collection and command', DURATION_BUCKETS)
+cloudinary_duration = Histogram('hashtage_cloudinary_call_duration_seconds', 'Cloudinary call latency by operation', DURATION_BUCKETS)
+request_identity_lookups = Histogram('hashtage_request_identity_lookups', 'Identity map hits and misses per request by route', COUNT_BUCKETS)
+
+HISTOGRAMS = (request_duration, request_mongo_commands, request_mongo_duration, mongo_command_duration, cloudinary_duration, request_identity_lookups)
+
+
+# CLASS RequestStats
+class RequestStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.mongo_commands = 0
+        self.mongo_time = 0.0
+        self.mongo_by_operation = defaultdict(float)
+        self.cloudinary_calls = 0
+        self.cloudinary_time = 0.0
+        self.identity_hits = 0
+        self.identity_misses = 0
+
+    def slowest_operation(self):
+        if not self.mongo_by_operation:
+            return None
+
+        return max(self.mongo_by_operation, key=self.mongo_by_operation.get)
+
+
+# FUNCTION current_stats()
+def current_stats():
+    return g.get('request_stats') if has_request_context() else None
+
+
+# CLASS CommandListener
+# Commands are matched to their collection by the started event, since the succeeded and
+# failed events only carry the reply.
+class CommandListener(monitoring.CommandListener):
+    def __init__(self):
+        self.collections = {}
+        self.lock = threading.Lock()
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+
+        with self.lock:
+            self.collections[(event.connection_id, event.request_id)] = collection if isinstance(collection, str) else event.database_name
+
+    def succeeded(self, event):
+        self.record(event)
+
+    def failed(self, event):
+        self.record(event)
+
+    def record(self, event):
+        with self.lock:
+            collection = self.collections.pop((event.connection_id, event.request_id), None)
+
+        seconds = event.duration_micros / 1e6
+        mongo_command_duration.observe({ 'collection': collection, 'command': event.command_name }, seconds)
+
+        stats = current_stats()
+
+        if stats is not None:
+            stats.mongo_commands += 1
+            stats.mongo_time += seconds
+            stats.mongo_by_operation[f'{collection}.{event.command_name}'] += seconds
+
+
+# FUNCTION cloudinary_call()
+# Calls a cloudinary.api or uploader function and records how long it took.
+def cloudinary_call(function, *args, **kwargs):
+    started = time.perf_counter()
+
+    try:
+        return function(*args, **kwargs)
+    finally:
+        seconds = time.perf_counter() - started
+        cloudinary_duration.observe({ 'operation': function.__name__ }, seconds)
+
+        stats = current_stats()
+
+        if stats is not None:
+            stats.cloudinary_calls += 1
+            stats.cloudinary_time += seconds
+
+
+# FUNCTION start_request()
+def start_request():
+    g.request_stats = RequestStats()
+
+
+# FUNCTION finish_request()
+def finish_request(response):
+    stats = current_stats()
+
+    if stats is None:
+        return response
+
+    seconds = time.perf_counter() - stats.started
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    labels = { 'route': route, 'method': request.method }
+
+    request_duration.observe({ **labels, 'status': str(response.status_code) }, seconds)
+    request_mongo_commands.observe(labels, stats.mongo_commands)
+    request_mongo_duration.observe(labels, stats.mongo_time)
+    request_identity_lookups.observe({ **labels, 'result': 'hit' }, stats.identity_hits)
+    request_identity_lookups.observe({ **labels, 'result': 'miss' }, stats.identity_misses)
+
+    summary = {
+        'method': request.method,
+        'route': route,
+        'status': response.status_code,
+        'duration_ms': round(seconds * 1000, 1),
+        'mongo_commands': stats.mongo_commands,
+        'mongo_ms': round(stats.mongo_time * 1000, 1),
+        'mongo_slowest': stats.slowest_operation(),
+        'cloudinary_calls': stats.cloudinary_calls,
+        'cloudinary_ms': round(stats.cloudinary_time * 1000, 1),
+        'identity_hits': stats.identity_hits,
+        'identity_misses': stats.identity_misses
+    }
+
+    if seconds * 1000 >= current_app.config['SLOW_REQUEST_MS']:
+        logger.warning('Slow request %s', json.dumps(summary))
+
+    if time.monotonic() - snapshot_written >= current_app.config['METRICS_WRITE_SECONDS']:
+        write_snapshot()
+
+    if current_app.debug:
+        response.headers['X-Mongo-Commands'] = str(summary['mongo_commands'])
+        response.headers['X-Mongo-Time-Ms'] = str(summary['mongo_ms'])
+        response.headers['X-Mongo-Slowest'] = str(summary['mongo_slowest'])
+        response.headers['X-Cloudinary-Calls'] = str(summary['cloudinary_calls'])
+        response.headers['X-Cloudinary-Time-Ms'] = str(summary['cloudinary_ms'])
+        response.headers['X-Identity-Map'] = f"{summary['identity_hits']} hits, {summary['identity_misses']} misses"
+
+    return response
+
+
+# FUNCTION write_snapshot()
+# Writes this process's histograms to its file in METRICS_DIR, replacing the last one. The
+# file is named after the pid, which differs in each worker forked from a preloaded app.
+def write_snapshot():
+    global snapshot_written
+
+    if snapshot_dir is None:
+        return
+
+    snapshot_written = time.monotonic()
+    snapshot_path = snapshot_dir / f'{os.getpid()}.json'
+    temporary = snapshot_path.with_suffix('.tmp')
+
+    try:
+        snapshot_dir.mkdir(parents=True, exist_ok=True)
+        temporary.write_text(json.dumps({ histogram.name: histogram.snapshot() for histogram in HISTOGRAMS }))
+        os.replace(temporary, snapshot_path)
+    except OSError:
+        logger.warning('Could not write metrics snapshot', exc_info=True)
+
+
+# FUNCTION collect()
+# Sums the snapshots in a directory and renders them in the Prometheus text format.
+def collect(directory):
+    totals = [Histogram(histogram.name, histogram.help, histogram.buckets) for histogram in HISTOGRAMS]
+
+    for path in Path(directory).glob('*.json'):
+        try:
+            snapshot = json.loads(path.read_text())
+        except (OSError, ValueError):
+            continue
+
+        for histogram in totals:
+            histogram.merge(snapshot.get(histogram.name, []))
+
+    lines = []
+
+    for histogram in totals:
+        lines += histogram.render()
+
+    return '\n'.join(lines) + '\n'
+
+
+# FUNCTION clear_snapshots()
+# Called when the server starts, so counts restart with it.
+def clear_snapshots(directory):
+    Path(directory).mkdir(parents=True, exist_ok=True)
+
+    for path in Path(directory).glob('*.json'):
+        path.unlink()
+
+
+# FUNCTION metrics_server()
+# An HTTP server answering /metrics from the snapshots in a directory.
+def metrics_server(bind, directory):
+    host, port = bind.rsplit(':', 1)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+
+            body = collect(directory).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return ThreadingHTTPServer((host, int(port)), Handler)
+
+
+# FUNCTION serve_metrics()
+# Runs metrics_server() on a background thread.
+def serve_metrics(bind, directory):
+    server = metrics_server(bind, directory)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+
+    return server
+
+
+# FUNCTION init_metrics()
+# Must run before the Mongo client is created so the listener sees its commands.
+def init_metrics(app):
+    global listener, snapshot_dir
+
+    if listener is None:
+        listener = CommandListener()
+        monitoring.register(listener)
+        atexit.register(write_snapshot)
+
+    snapshot_dir = Path(app.config['METRICS_DIR'])
+
+    app.before_request(start_request)
+    app.after_request(finish_request)
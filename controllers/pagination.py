@@ -0,0 +1,118 @@
+# pagination.py
+
+import base64
+import binascii
+import heapq
+from bson import ObjectId
+from bson.errors import InvalidId
+from flask import request, abort, make_response
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+# Lists are paginated on _id, newest first. `before` pages towards older items and `after`
+# towards newer ones; `next_cursor` continues in the same direction as the request and is
+# None once there is nothing left. Feeds that are polled also take `since`, which keeps the
+# newest-first order but leaves out everything up to the cursor.
+
+
+# FUNCTION encode_cursor()
+def encode_cursor(object_id):
+    return base64.urlsafe_b64encode(object_id.binary).decode('ascii')
+
+
+# FUNCTION decode_cursor()
+def decode_cursor(cursor):
+    if cursor is None:
+        return None
+
+    try:
+        return ObjectId(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (binascii.Error, InvalidId, TypeError, UnicodeEncodeError, ValueError):
+        abort(make_response({ 'get': False, 'message': 'Invalid cursor' }, 400))
+
+
+# FUNCTION page_limit()
+def page_limit():
+    return min(max(request.args.get('limit', DEFAULT_LIMIT, type=int), 1), MAX_LIMIT)
+
+
+# FUNCTION page_args()
+def page_args():
+    return {
+        'limit': page_limit(),
+        'before': decode_cursor(request.args.get('before')),
+        'after': decode_cursor(request.args.get('after'))
+    }
+
+
+# FUNCTION since_arg()
+def since_arg():
+    return decode_cursor(request.args.get('since'))
+
+
+# FUNCTION stream()
+# Yields (key, queryset, row) for the raw rows of a queryset in page order. Rows are not
+# turned into documents here, so sources can be merged without building every candidate.
+def stream(queryset, field, limit, before, after, since=None):
+    lower = max((cursor for cursor in (after, since) if cursor is not None), default=None)
+
+    if before is not None:
+        queryset = queryset.filter(**{ f'{field}__lt': before })
+    if lower is not None:
+        queryset = queryset.filter(**{ f'{field}__gt': lower })
+
+    db_field = queryset._document._fields[field].db_field
+    rows = queryset.order_by(field if after is not None else f'-{field}').limit(limit + 1).batch_size(limit + 1)
+
+    for row in rows.as_pymongo():
+        yield row[db_field], queryset, row
+
+
+# FUNCTION paginate()
+# Pages one or more querysets together by _id. The sources are streamed in cursor order and
+# merged lazily with a heap, which stops as soon as the page is full; only the rows that make
+# the page are turned into documents. A queryset can be given as a (queryset, field) pair to
+# page it on another ObjectId field, and items that share a cursor value are listed once.
+def paginate(*querysets, limit=DEFAULT_LIMIT, before=None, after=None, since=None):
+    streams = []
+
+    for queryset in querysets:
+        queryset, field = queryset if isinstance(queryset, tuple) else (queryset, 'id')
+        streams.append(stream(queryset, field, limit, before, after, since))
+
+    rows = []
+    seen = set()
+
+    for key, queryset, row in heapq.merge(*streams, key=lambda item: item[0], reverse=after is None):
+        if key in seen:
+            continue
+
+        seen.add(key)
+        rows.append((key, queryset, row))
+
+        if len(rows) > limit:
+            break
+
+    page = [queryset._document._from_son(row, _auto_dereference=queryset._auto_dereference) for key, queryset, row in rows[:limit]]
+    next_cursor = encode_cursor(rows[limit - 1][0]) if len(rows) > limit else None
+
+    if after is not None:
+        page.reverse()
+
+    return page, next_cursor
+
+
+# FUNCTION paginate_ranked()
+# Results ranked by relevance have no stable key to cut on, so their `before` cursor is an
+# opaque offset instead of an _id.
+def paginate_ranked(queryset, limit=DEFAULT_LIMIT, before=None):
+    try:
+        offset = int(base64.urlsafe_b64decode(before.encode('ascii'))) if before is not None else 0
+    except (binascii.Error, UnicodeEncodeError, ValueError):
+        abort(make_response({ 'get': False, 'message': 'Invalid cursor' }, 400))
+
+    items = list(queryset.skip(max(offset, 0)).limit(limit + 1))
+    next_cursor = base64.urlsafe_b64encode(str(offset + limit).encode('ascii')).decode('ascii') if len(items) > limit else None
+
+    return items[:limit], next_cursor
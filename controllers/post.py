@@ -1,18 +1,44 @@
 # post.py
 
 import pprint
-from flask import Blueprint, request
+import threading
+import time
+from flask import Blueprint, Response, current_app, request
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from models.user import User
 from models.post import Post
 from models.retweet import Retweet
 from models.like import Like
+from models.timeline import TimelineEntry
+from models.follow import Follow
 from mongoengine.queryset.visitor import Q
-from cloudinary import uploader, api
-import time
+from controllers.hydrator import hydrate_posts, hydrate_shares, load_author
+from controllers.pagination import page_args, page_limit, since_arg, paginate, paginate_ranked, encode_cursor
+from controllers.fanout import fan_out, pulled_accounts
+from controllers.purge import delete_in_background
+from controllers.media import upload_images
+from controllers.cache import invalidate_posts
+from controllers.identity import reference_id
+from controllers.etag import make_etag, not_modified, etag_response, post_versions, user_versions
+from controllers.events import get_broker, publish_item, publish_counters, format_event
+from controllers.counters import increment_counters
+from controllers.batch import applyRelation
+from collections import defaultdict
+from bson import ObjectId
 
 post_bp = Blueprint('post_bp', __name__)
 
+DEFAULT_DEPTH = 3
+MAX_DEPTH = 10
+DEFAULT_CHILDREN = 10
+MAX_CHILDREN = 50
+MAX_IDS = 100
+MAX_THREAD_REPLIES = 1000
+
+# Streams open in this process, capped at STREAM_MAX_OPEN
+open_streams = 0
+streams_lock = threading.Lock()
+
 # create_post()
 @post_bp.route('/post', methods=['POST'])
 @jwt_required()
@@ -25,141 +51,113 @@ def create_post():
     post.save()
 
     if 'images' in request.files:
-        post.update(img_path=f'hashtage/{str(post.author.pk)}/{str(post.pk)}')
-        post.reload()
+        upload_images(post, request.files.getlist('images'))
 
-        for index, image in enumerate(request.files.getlist('images'), start=1):
-            print(index, image.filename)
-            uploader.upload_image(image, folder=f'hashtage/{str(post.author.pk)}/{str(post.pk)}', 
-            public_id=str(time.time()))
+    fan_out(author, post.pk, post.pk)
+    publish_item('post', author, post.pk, post.pk)
     
     return {
         'created': True,
         'post': {
             'id': str(post.pk),
-            'author': post.author,
+            'author': load_author(author),
             'text': post.text,
             'date': post.date,
-            'img_path': post.img_path
+            'img_path': post.img_path,
+            'images': [image.url for image in post.images],
+            'media_status': post.media_status
         }
     }, 201
 
 
-# FUNCTION deleteChildrenImages
-def deleteChildrenImages(comment_parent):
-    for comment in Post.objects(parent=comment_parent):
-        if comment.img_path is not None:
-            api.delete_resources_by_prefix(comment.img_path)
-            api.delete_folder(comment.img_path)
-        
-        deleteChildrenImages(str(comment.pk))
-
-
 # delete_post()
+# Tombstones the post and leaves removing its replies, likes, retweets and images to a
+# background job.
 @post_bp.route('/post/<string:post_id>', methods=['DELETE'])
 @jwt_required()
 def delete_post(post_id):
-    post = Post.objects(id=post_id).first()
+    post = Post.objects(id=post_id, deleted__ne=True).modify(set__deleted=True)
 
     if post is not None:
-        if post.img_path is not None:
-            api.delete_resources_by_prefix(post.img_path)
-            api.delete_folder(post.img_path)
-        
-        comments = Post.objects(parent=str(post.pk))
-
-        for comment in Post.objects(parent=str(post.pk)):
-            if comment.img_path is not None:
-                print(comment.img_path)
-                api.delete_resources_by_prefix(comment.img_path)
-                api.delete_folder(comment.img_path)
-                
-            deleteChildrenImages(str(comment.pk))
-        
-        post.delete()
+        parent_id = reference_id(post, 'parent')
+
+        if parent_id is not None:
+            Post.objects(id=parent_id).update_one(dec__comments_count=1)
+
+        invalidate_posts(post.pk, parent_id)
+        delete_in_background(post.pk)
 
         return {
             'deleted': True,
             'post': {
                 'id': str(post.pk),
-                'author': post.author,
+                'author': load_author(reference_id(post, 'author')),
                 'text': post.text,
                 'date': post.date,
                 'img_path': post.img_path,
-                'comments': comments
+                'comments_count': post.comments_count
             }
         }, 200
     else:
         return { 'deleted': False, 'message': 'Post not found' }, 409
 
 
+# FUNCTION latest_cursor()
+# The cursor to poll with `?since=` next: the newest key on a first page, or the given `since`
+# when nothing is newer. Pages further down a feed have none.
+def latest_cursor(keys, args, since):
+    if args['before'] is not None:
+        return None
+
+    if keys:
+        return encode_cursor(max(keys))
+
+    return encode_cursor(since) if since is not None else None
+
+
 # get_all_posts()
+# `?since=<latest_cursor>` returns only the posts newer than an earlier response. When
+# next_cursor is set there were more than a page of them, and it pages down the gap.
 @post_bp.route('/post', methods=['GET'])
 @jwt_required()
 def get_all_posts():
+    args = page_args()
+    since = since_arg()
+
     try:
-        posts = []
-
-        for post in Post.objects(parent=None).order_by('-id'):
-            if post.img_path is not None:
-                images_resources = api.resources(type='upload', prefix=post.img_path)['resources']
-                images = [image['secure_url'] for image in images_resources]
-            else:
-                images = []
-            
-            isAuthor = True if str(post.author.id) == get_jwt_identity() else False
-            
-            didRetweet = False
-            for retweet in Retweet.objects(post_id=str(post.pk)).order_by('-id'):
-                if str(retweet.user_id.pk) == get_jwt_identity():
-                    didRetweet = True
-            
-            didLike = False
-            for like in Like.objects(post_id=str(post.id)).order_by('-id'):
-                if str(like.user_id.id) == get_jwt_identity():
-                    didLike = True
-
-                posts.append({
-                    'id': str(retweet.pk),
-                    'user_id': {
-                        'id': str(retweet.user_id.pk),
-                        'full_name': retweet.user_id.full_name,
-                        'username': retweet.user_id.username
-                    },
-                    'post_id': {
-                        'id': str(retweet.post_id.pk),
-                        'author': retweet.post_id.author,
-                        'text': retweet.post_id.text,
-                        'date': retweet.post_id.date,
-                        'images': images,
-                        'retweets_count': Retweet.objects(post_id=str(retweet.post_id.pk)).count(),
-                        'didRetweet': didRetweet,
-                        'didLike': didLike,
-                        'comments_count': Post.objects(parent=str(retweet.post_id.pk)).count(),
-                        'likes_count': Like.objects(post_id=str(retweet.post_id.id)).count(),
-                        'isAuthor': isAuthor
-                    }
-                })
-            
-            posts.append({
-                'id': str(post.pk),
-                'author': post.author,
-                'text': post.text,
-                'date': post.date,
-                'images': images,
-                'retweets_count': Retweet.objects(post_id=str(post.pk)).count(),
-                'didRetweet': didRetweet,
-                'didLike': didLike,
-                'comments_count': Post.objects(parent=str(post.pk)).count(),
-                'likes_count': Like.objects(post_id=str(post.id)).count(),
-                'isAuthor': isAuthor
-            })
-
-        return { 'get': True, 'posts': posts }, 200
+        page, next_cursor = paginate(Post.objects(parent=None, deleted__ne=True).only('id'), **args, since=since)
+        latest = latest_cursor([post.id for post in page], args, since)
+        etag = make_etag(get_jwt_identity(), next_cursor, latest, post_versions([post.id for post in page], get_jwt_identity()))
+
+        if not_modified(etag):
+            return etag_response(etag)
+
+        posts = hydrate_posts([post.id for post in page], get_jwt_identity())
+
+        return etag_response(etag, { 'get': True, 'posts': posts, 'next_cursor': next_cursor, 'latest_cursor': latest })
     except:
         return { 'get': False, 'message': 'No posts' }, 409
 
 
+# get_posts()
+# Batch fetch of the cards of up to MAX_IDS posts, e.g. `/posts?ids=<id>,<id>`. Posts that do
+# not exist are left out.
+@post_bp.route('/posts', methods=['GET'])
+@jwt_required()
+def get_posts():
+    ids = list(dict.fromkeys(id for id in request.args.get('ids', '').split(',') if id))
+
+    if not 0 < len(ids) <= MAX_IDS or not all(ObjectId.is_valid(id) for id in ids):
+        return { 'get': False, 'message': f'Send between 1 and {MAX_IDS} valid ids' }, 400
+
+    etag = make_etag(get_jwt_identity(), post_versions(ids, get_jwt_identity()))
+
+    if not_modified(etag):
+        return etag_response(etag)
+
+    return etag_response(etag, { 'get': True, 'posts': hydrate_posts(ids, get_jwt_identity()) })
+
+
 # create_comment()
 @post_bp.route('/post/comment/<string:post_id>', methods=['POST'])
 @jwt_required()
@@ -168,165 +166,188 @@ def create_comment(post_id):
     author = get_jwt_identity()
     text = data['text']
 
-    comment = Post(author=author, text=text, parent=post_id)
+    parent = Post.objects(id=post_id, deleted__ne=True).only('ancestors', 'depth').first()
+
+    if parent is None:
+        return { 'created': False, 'message': 'Post not found' }, 409
+
+    comment = Post(author=author, text=text, parent=post_id, ancestors=parent.ancestors + [parent.id], depth=parent.depth + 1)
     comment.save()
+    Post.objects(id=post_id).update_one(inc__comments_count=1)
+    invalidate_posts(post_id)
+    publish_counters(post_id, comments_count=1)
 
     if 'images' in request.files:
-        comment.update(img_path=f'hashtage/{str(comment.author.pk)}/{str(comment.pk)}')
-        for index, image in enumerate(request.files.getlist('images'), start=1):
-            print(index, image.filename)
-            uploader.upload_image(image, folder=f'hashtage/{str(comment.author.pk)}/{str(comment.pk)}',
-            public_id=str(time.time()))
+        upload_images(comment, request.files.getlist('images'))
 
     return {
         'created': True,
         'comment': {
             'id': str(comment.pk),
             'text': comment.text,
-            'author': comment.author,
+            'author': load_author(author),
             'date': comment.date,
             'img_path': comment.img_path,
-            'parent': comment.parent
+            'images': [image.url for image in comment.images],
+            'media_status': comment.media_status,
+            'parent': str(parent.id)
         }
     }, 201
 
 
-# FUNCTION getChildren()
-def getChildren(comment_parent):
-    children = []
-
-    for comment in Post.objects(parent=comment_parent):
-        if comment.img_path is not None:
-            images_resources = api.resources(type='upload', prefix=comment.img_path)['resources']
-            images = [image['secure_url'] for image in images_resources]
-        else:
-            images = []
-        
-        didRetweet = False
-        for retweet in Retweet.objects(post_id=str(comment.pk)):
-            if str(retweet.user_id.pk) == get_jwt_identity():
-                didRetweet = True
-
-        didLike = False
-        for like in Like.objects(post_id=str(comment.id)):
-            if str(like.user_id.id) == get_jwt_identity():
-                didLike = True
-        
-        isAuthor = True if str(comment.author.id) == get_jwt_identity() else False
-        
-        children.append({
-            'id': str(comment.pk),
-            'author': {
-                'id': str(comment.author.id),
-                'full_name': comment.author.full_name,
-                'username': comment.author.username
-            },
-            'text': comment.text,
-            'date': comment.date,
-            'images': images,
-            'parent': str(comment.parent.id),
-            'retweets_count': Retweet.objects(post_id=str(comment.pk)).count(),
-            'didRetweet': didRetweet,
-            'didLike': didLike,
-            'comments_count': Post.objects(parent=str(comment.pk)).count(),
-            'likes_count': Like.objects(post_id=str(comment.id)).count(),
-            'children': getChildren(str(comment.pk)),
-            'isAuthor': isAuthor
-        })
-    
-    return children
+# FUNCTION threadArgs()
+def threadArgs():
+    max_depth = request.args.get('max_depth', DEFAULT_DEPTH, type=int)
+    max_children = request.args.get('max_children', DEFAULT_CHILDREN, type=int)
+
+    return min(max(max_depth, 1), MAX_DEPTH), min(max(max_children, 1), MAX_CHILDREN)
+
+
+# FUNCTION threadSkeleton()
+# Loads the ids of the replies under a post level by level on the (parent, id) index. The
+# children of the post are paged in the query, from `after` on; each lower level is one
+# query for the children of the level above, capped at max_children per parent shown. A
+# post whose replies were cut off, per its comments_count, gets a cursor to pass as `after`
+# to /post/<id>/replies. At most MAX_THREAD_REPLIES ids are loaded in all.
+def threadSkeleton(post, max_depth, max_children, after=None):
+    query = Post.objects(parent=post.id, deleted__ne=True)
+
+    if after is not None:
+        query = query.filter(id__gt=after)
+
+    level = list(query.only('comments_count').order_by('id').limit(max_children + 1).as_pymongo())
+    cursors = {}
+
+    if len(level) > max_children:
+        level = level[:max_children]
+        cursors[post.id] = encode_cursor(level[-1]['_id'])
+
+    kept = [row['_id'] for row in level]
+    expanded = set()
+
+    for _ in range(max_depth - 1):
+        parents = [row['_id'] for row in level if row.get('comments_count', 0) > 0]
+
+        if not parents or len(kept) >= MAX_THREAD_REPLIES:
+            break
+
+        rows = Post.objects(parent__in=parents, deleted__ne=True).only('parent', 'comments_count').order_by('id') \
+            .limit(min(len(parents) * max_children, MAX_THREAD_REPLIES - len(kept))).as_pymongo()
+
+        replies = defaultdict(list)
+        for row in rows:
+            if len(replies[row['parent']]) < max_children:
+                replies[row['parent']].append(row)
+
+        next_level = []
+
+        for row in level:
+            shown = replies[row['_id']]
+
+            if shown:
+                expanded.add(row['_id'])
+
+                if row.get('comments_count', 0) > len(shown):
+                    cursors[row['_id']] = encode_cursor(shown[-1]['_id'])
+
+            kept += [reply['_id'] for reply in shown]
+            next_level += shown
+
+        level = next_level
+
+    # Replies whose own replies were not loaded are expanded from themselves by buildThread()
+    return kept, cursors, { reply_id for reply_id in kept if reply_id not in expanded }
+
+
+# FUNCTION buildThread()
+# Hydrates the kept replies and builds the tree in memory.
+def buildThread(post_id, kept, cursors, cut):
+    cards = { post_id: { 'children': [] } }
+
+    for card in hydrate_posts(kept, get_jwt_identity()):
+        # Replies under a deleted post are skipped along with it
+        if ObjectId(card['parent']) not in cards:
+            continue
+
+        card['children'] = []
+        card['next_cursor'] = cursors.get(ObjectId(card['id']))
+
+        # Replies below max_depth were not loaded, they are expanded from their parent
+        if ObjectId(card['id']) in cut and card['comments_count'] > 0:
+            card['next_cursor'] = encode_cursor(ObjectId(card['id']))
+
+        cards[ObjectId(card['parent'])]['children'].append(card)
+        cards[ObjectId(card['id'])] = card
+
+    return cards[post_id]['children'], cursors.get(post_id)
     
 
 # get_post_info()
 @post_bp.route('/post/<string:post_id>', methods=['GET'])
 @jwt_required()
 def get_post_info(post_id):
-    post = Post.objects(id=post_id).first()
+    thread = Post.objects(id=post_id, deleted__ne=True).only('depth').first()
 
-    if post.img_path is not None:
-        images_resources = api.resources(type='upload', prefix=post.img_path)['resources']
-        images = [image['secure_url'] for image in images_resources]
-    else:
-        images = []
+    if thread is None:
+        return { 'get': False, 'message': 'Post not found' }, 409
 
-    didRetweet = False
-    for retweet in Retweet.objects(post_id=str(post.pk)):
-        if str(retweet.user_id.pk) == get_jwt_identity():
-            didRetweet = True
-    
-    didLike = False
-    for like in Like.objects(post_id=str(post.id)):
-        if str(like.user_id.id) == get_jwt_identity():
-            didLike = True
-
-    comments = []
-
-    for comment in Post.objects(parent=post_id):
-        if comment.img_path is not None:
-            comment_resources = api.resources(type='upload', prefix=comment.img_path)['resources']
-            comment_images = [image['secure_url'] for image in comment_resources]
-        else:
-            comment_images = []
-        
-        didRetweetComment = False
-        for retweet in Retweet.objects(post_id=str(comment.pk)):
-            if str(retweet.user_id.pk) == get_jwt_identity():
-                didRetweetComment = True
-        
-        didLikeComment = False
-        for like in Like.objects(post_id=str(comment.id)):
-            if str(like.user_id.id) == get_jwt_identity():
-                didLikeComment = True
-
-        isAuthorComment = True if get_jwt_identity() == str(comment.author.id) else False
-
-        comments.append({
-            'id': str(comment.pk),
-            'author': comment.author,
-            'text': comment.text,
-            'date': comment.date,
-            'images': comment_images,
-            'parent': comment.parent,
-            'retweets_count': Retweet.objects(post_id=str(comment.pk)).count(),
-            'didRetweet': didRetweetComment,
-            'didLike': didLikeComment,
-            'comments_count': Post.objects(parent=str(comment.pk)).count(),
-            'likes_count': Like.objects(post_id=str(comment.id)).count(),
-            'children': getChildren(str(comment.pk)),
-            'isAuthor': isAuthorComment
-        })
-
-    isAuthor = True if get_jwt_identity() == str(post.author.id) else False
-        
-    return {
-        'id': str(post.pk),
-        'author': post.author,
-        'text': post.text,
-        'date': post.date,
-        'images': images,
-        'retweets_count': Retweet.objects(post_id=post_id).count(),
-        'didRetweet': didRetweet,
-        'didLike': didLike,
-        'comments_count': Post.objects(parent=post_id).count(),
-        'likes_count': Like.objects(post_id=post_id).count(),
-        'children': comments,
-        'isAuthor': isAuthor
-    }
+    kept, cursors, cut = threadSkeleton(thread, *threadArgs())
+    etag = make_etag(get_jwt_identity(), kept, post_versions([thread.id] + kept, get_jwt_identity()))
+
+    if not_modified(etag):
+        return etag_response(etag)
+
+    post = hydrate_posts([thread.id], get_jwt_identity())[0]
+    post['children'], post['next_cursor'] = buildThread(thread.id, kept, cursors, cut)
+
+    return etag_response(etag, post)
+
+
+# get_replies()
+@post_bp.route('/post/<string:post_id>/replies', methods=['GET'])
+@jwt_required()
+def get_replies(post_id):
+    thread = Post.objects(id=post_id, deleted__ne=True).only('depth').first()
+
+    if thread is None:
+        return { 'get': False, 'message': 'Post not found' }, 409
+
+    kept, cursors, cut = threadSkeleton(thread, *threadArgs(), after=page_args()['after'])
+    etag = make_etag(get_jwt_identity(), kept, post_versions(kept, get_jwt_identity()))
+
+    if not_modified(etag):
+        return etag_response(etag)
+
+    children, next_cursor = buildThread(thread.id, kept, cursors, cut)
+
+    return etag_response(etag, { 'get': True, 'children': children, 'next_cursor': next_cursor })
 
 
 # retweet()
+# Upserted like in /batch, so a repeated retweet is reported without relying on the unique
+# index, which only `flask build-indexes` creates.
 @post_bp.route('/post/retweet/<string:post_id>', methods=['POST'])
 @jwt_required()
 def retweet(post_id):
-    retweet = Retweet(user_id=get_jwt_identity(), post_id=post_id)
-    retweet.save()
+    added, removed = applyRelation('retweet', ObjectId(get_jwt_identity()), { ObjectId(post_id): True })
+
+    if not added:
+        return { 'created': False, 'message': 'Post already retweeted' }, 409
+
+    retweet_id = added[ObjectId(post_id)]
+
+    increment_counters({ post_id: { 'retweets_count': 1 } })
+    invalidate_posts(post_id)
+    fan_out(get_jwt_identity(), retweet_id, ObjectId(post_id), retweet_id)
+    publish_item('retweet', get_jwt_identity(), retweet_id, post_id)
+    publish_counters(post_id, retweets_count=1)
 
     return {
         'created': True,
         'retweet': {
-            'id': str(retweet.pk),
-            'user_id': retweet.user_id,
-            'post_id': retweet.post_id
+            'id': str(retweet_id),
+            'user_id': load_author(get_jwt_identity()),
+            'post_id': post_id
         }
     }, 201
 
@@ -339,13 +360,16 @@ def unretweet(post_id):
 
     if retweet is not None:
         retweet.delete()
+        increment_counters({ post_id: { 'retweets_count': -1 } })
+        invalidate_posts(post_id)
+        publish_counters(post_id, retweets_count=-1)
 
         return {
             'deleted': True,
             'retweet': {
                 'id': str(retweet.pk),
-                'user_id': retweet.user_id,
-                'post_id': retweet.post_id
+                'user_id': load_author(get_jwt_identity()),
+                'post_id': post_id
             }
         }, 200
     else:
@@ -353,41 +377,33 @@ def unretweet(post_id):
     
 
 # search()
+# `#tag` and `@username` look posts up by their extracted hashtags and mentions, newest first.
+# Anything else runs on the text index, ranked by relevance. Users are matched by prefix on
+# their username or the words of their name, for typeahead.
 @post_bp.route('/search/<string:text>', methods=['GET'])
 @jwt_required()
 def search(text):
-    posts = []
-
-    for post in Post.objects(text__icontains=text).order_by('-id'):
-        if post.img_path is not None:
-            images_resources = api.resources(type='upload', prefix=post.img_path)['resources']
-            images = [image['secure_url'] for image in images_resources]
-        else:
-            images = []
-        
-        didRetweet = False
-        for retweet in Retweet.objects(post_id=str(post.pk)):
-            if str(retweet.user_id.pk) == get_jwt_identity():
-                didRetweet = True
-        
-        didLike = False
-        for like in Like.objects(post_id=str(post.id)):
-            if str(like.user_id.id) == get_jwt_identity():
-                didLike = True
-        
-        posts.append({
-            'id': str(post.pk),
-            'author': post.author,
-            'text': post.text,
-            'date': post.date,
-            'images': images,
-            'parent': post.parent,
-            'retweets_count': Retweet.objects(post_id=str(post.pk)).count(),
-            'didRetweet': didRetweet,
-            'didLike': didLike,
-            'comments_count': Post.objects(parent=str(post.pk)).count(),
-            'likes_count': Like.objects(post_id=str(post.id)).count()
-        })
+    query = text.strip().lower()
+    first_page = request.args.get('before') is None and request.args.get('after') is None
+
+    if query.startswith('#') or query.startswith('@'):
+        field = 'hashtags' if query.startswith('#') else 'mentions'
+        page, next_cursor = paginate(Post.objects(**{ field: query[1:] }, deleted__ne=True).only('id'), **page_args())
+        prefix = query[1:]
+    else:
+        page, next_cursor = paginate_ranked(Post.objects(deleted__ne=True).search_text(text).order_by('$text_score').only('id'),
+        page_limit(), request.args.get('before'))
+        prefix = query
+
+    # Matching users are only listed on the first page
+    matches = list(User.objects(Q(username_lower__startswith=prefix) | Q(name_tokens__startswith=prefix)).no_dereference().limit(page_limit())) if first_page and prefix else []
+    etag = make_etag(get_jwt_identity(), next_cursor, post_versions([post.id for post in page], get_jwt_identity()),
+    [[user.pk, user.version, user.followers_count, user.following_count] for user in matches])
+
+    if not_modified(etag):
+        return etag_response(etag)
+
+    posts = hydrate_posts([post.id for post in page], get_jwt_identity())
 
     users = [{
         'id': str(user.pk),
@@ -396,29 +412,37 @@ def search(text):
         'address': user.address,
         'birthday': user.birthday,
         'bio': user.bio,
-        'followers': len(user.followers),
-        'following': len(user.following)
-    } for user in User.objects(Q(username__icontains=text) | Q(full_name__icontains=text))]
+        'followers': user.followers_count,
+        'following': user.following_count
+    } for user in matches]
 
-    return {
+    return etag_response(etag, {
         'posts': posts,
-        'users': users
-    }, 200
+        'users': users,
+        'next_cursor': next_cursor
+    })
 
 
 # like()
+# Upserted like retweet().
 @post_bp.route('/post/like/<string:post_id>', methods=['POST'])
 @jwt_required()
 def like(post_id):
-    like = Like(user_id=get_jwt_identity(), post_id=post_id)
-    like.save()
+    added, removed = applyRelation('like', ObjectId(get_jwt_identity()), { ObjectId(post_id): True })
+
+    if not added:
+        return { 'created': False, 'message': 'Post already liked' }, 409
+
+    increment_counters({ post_id: { 'likes_count': 1 } })
+    invalidate_posts(post_id)
+    publish_counters(post_id, likes_count=1)
 
     return {
         'created': True,
         'like': {
-            'id': str(like.id),
-            'user_id': like.user_id,
-            'post_id': like.post_id
+            'id': str(added[ObjectId(post_id)]),
+            'user_id': load_author(get_jwt_identity()),
+            'post_id': post_id
         }
     }, 201
 
@@ -431,13 +455,16 @@ def unlike(post_id):
 
     if like is not None:
         like.delete()
+        increment_counters({ post_id: { 'likes_count': -1 } })
+        invalidate_posts(post_id)
+        publish_counters(post_id, likes_count=-1)
 
         return {
             'deleted': True,
             'like': {
                 'id': str(like.id),
-                'user_id': like.user_id,
-                'post_id': like.post_id
+                'user_id': load_author(get_jwt_identity()),
+                'post_id': post_id
             }
         }, 200
     else:
@@ -445,89 +472,126 @@ def unlike(post_id):
 
 
 # timeline()
+# Reads the viewer's inbox, filled on write by the fan-out workers, and merges in the
+# accounts that are too large to fan out. Takes `?since=` like get_all_posts().
 @post_bp.route('/timeline', methods=['GET'])
 @jwt_required()
 def timeline():
-    user = User.objects(id=get_jwt_identity()).first()
-
-    posts = []
-
-    for following in user.following:
-
-        for post in Post.objects(author=str(following.id), parent=None).order_by('-id'):
-            if post.img_path is not None:
-                images_resources = api.resources(type='upload', prefix=post.img_path)['resources']
-                images = [image['secure_url'] for image in images_resources]
-            else:
-                images = []
-
-            didRetweet = False
-            for retweet in Retweet.objects(post_id=str(post.id)):
-                if str(retweet.user_id.id) == get_jwt_identity():
-                    didRetweet = True
-            
-            didLike = False
-            for like in Like.objects(post_id=str(post.id)):
-                if str(like.user_id.id) == get_jwt_identity():
-                    didLike = True
-                
-            isAuthor = True if str(post.author.id) == get_jwt_identity() else False
-
-            posts.append({
-                'id': str(post.id),
-                'author': post.author,
-                'text': post.text,
-                'date': post.date,
-                'images': images,
-                'retweets_count': Retweet.objects(post_id=str(post.id)).count(),
-                'comments_count': Post.objects(parent=str(post.id)).count(),
-                'likes_count': Like.objects(post_id=str(post.id)).count(),
-                'didRetweet': didRetweet,
-                'didLike': didLike,
-                'isAuthor': isAuthor
-            })
-        for retweet in Retweet.objects(user_id=str(following.id)).order_by('-id'):
-            if retweet.post_id.img_path is not None:
-                retweet_resources = api.resources(type='upload', prefix=retweet.post_id.img_path)['resources']
-                retweet_images = [image['secure_url'] for image in retweet_resources]
-            else:
-                retweet_images = []
-
-            didRetweetPost = False
-            for r in Retweet.objects(post_id=str(retweet.post_id.id)):
-                if str(r.user_id.id) == get_jwt_identity():
-                    didRetweetPost = True
-            
-            didLikePost = False
-            for like in Like.objects(post_id=str(retweet.post_id.id)):
-                if str(like.user_id.id) == get_jwt_identity():
-                    didLikePost = True
-            
-            isAuthorPost = True if str(retweet.post_id.author.id) == get_jwt_identity() else False
-
-            posts.append({
-                'id': str(retweet.id),
-                'post_id': {
-                    'id': str(retweet.post_id.id),
-                    'author': retweet.post_id.author,
-                    'text': retweet.post_id.text,
-                    'date': retweet.post_id.date,
-                    'images': retweet_images,
-                    'retweets_count': Retweet.objects(post_id=str(retweet.post_id.id)).count(),
-                    'comments_count': Post.objects(parent=str(retweet.post_id.id)).count(),
-                    'likes_count': Like.objects(post_id=str(retweet.post_id.id)).count(),
-                    'didRetweet': didRetweetPost,
-                    'didLike': didLikePost,
-                    'isAuthor': isAuthorPost
-                },
-                'user_id': {
-                    'id': str(retweet.user_id.id),
-                    'full_name': retweet.user_id.full_name,
-                    'username': retweet.user_id.username
-                }
-            })
+    args = page_args()
+    since = since_arg()
+    following = [follow['following'] for follow in Follow.objects(follower=get_jwt_identity()).only('following').as_pymongo()]
+    pulled = pulled_accounts(following)
 
-    return {
+    sources = [(TimelineEntry.objects(owner=get_jwt_identity()).no_dereference(), 'item_id')]
+
+    if pulled:
+        sources.append(Post.objects(author__in=pulled, parent=None, deleted__ne=True).only('id'))
+        sources.append(Retweet.objects(user_id__in=pulled).no_dereference())
+
+    page, next_cursor = paginate(*sources, **args, since=since)
+    keys = [item.item_id if isinstance(item, TimelineEntry) else item.id for item in page]
+    latest = latest_cursor(keys, args, since)
+
+    post_ids = [item.post_id.id if isinstance(item, TimelineEntry) else item.id for item in page
+        if isinstance(item, Post) or (isinstance(item, TimelineEntry) and item.retweet_id is None)]
+    retweet_ids = [item.retweet_id.id for item in page if isinstance(item, TimelineEntry) and item.retweet_id is not None]
+    retweets = [item for item in page if isinstance(item, Retweet)]
+
+    if retweet_ids:
+        retweets += Retweet.objects(id__in=retweet_ids).no_dereference()
+
+    etag = make_etag(get_jwt_identity(), next_cursor, latest, [str(item.id) for item in page],
+    post_versions(post_ids + [retweet.post_id.id for retweet in retweets], get_jwt_identity()),
+    user_versions(retweet.user_id.id for retweet in retweets))
+
+    if not_modified(etag):
+        return etag_response(etag)
+
+    posts = hydrate_posts(post_ids, get_jwt_identity())
+    retweets = hydrate_shares(retweets, get_jwt_identity())
+
+    # Posts and retweets come back in the order of the page
+    items = { item['id']: item for item in posts + retweets }
+
+    return etag_response(etag, {
         'get': True,
-        'posts': posts
-    }, 200
\ No newline at end of file
+        'posts': [items[str(key)] for key in keys if str(key) in items],
+        'next_cursor': next_cursor,
+        'latest_cursor': latest
+    })
+
+
+# timeline_stream()
+# Server-Sent Events with the new posts and retweets of the accounts the viewer follows, and
+# the counter deltas of those items and of the posts listed in `?posts=`. Each item carries
+# its timeline cursor as the event id, so a client that reconnects catches up with
+# `/timeline?since=<Last-Event-ID>`; a 'reset' event means events were dropped and the
+# timeline should be reloaded. The stream ends after STREAM_MAX_SECONDS.
+# EventSource cannot set headers, so the token is also read from the access_token_cookie
+# cookie or the `?jwt=` parameter. Each stream holds a worker thread, so a process serves
+# at most STREAM_MAX_OPEN of them and answers 503 with Retry-After above that.
+@post_bp.route('/timeline/stream', methods=['GET'])
+@jwt_required(locations=['headers', 'cookies', 'query_string'])
+def timeline_stream():
+    global open_streams
+
+    viewer_id = get_jwt_identity()
+    post_ids = [id for id in request.args.get('posts', '').split(',') if id]
+
+    if len(post_ids) > MAX_IDS or not all(ObjectId.is_valid(id) for id in post_ids):
+        return { 'get': False, 'message': f'Send at most {MAX_IDS} valid ids' }, 400
+
+    following = [follow['following'] for follow in Follow.objects(follower=viewer_id).only('following').as_pymongo()]
+    heartbeat = current_app.config['STREAM_HEARTBEAT']
+    deadline = time.monotonic() + current_app.config['STREAM_MAX_SECONDS']
+
+    with streams_lock:
+        if open_streams >= current_app.config['STREAM_MAX_OPEN']:
+            return { 'get': False, 'message': 'Too many open streams, retry later' }, 503, { 'Retry-After': str(current_app.config['STREAM_RETRY_AFTER']) }
+
+        open_streams += 1
+
+    def release():
+        global open_streams
+
+        with streams_lock:
+            open_streams -= 1
+
+    # Run when the server closes the response, even if the generator never started
+    def close():
+        subscription.close()
+        release()
+
+    try:
+        subscription = get_broker().subscribe()
+    except Exception:
+        release()
+        raise
+
+    try:
+        subscription.add([f'user:{user_id}' for user_id in following] + [f'post:{post_id}' for post_id in post_ids])
+    except Exception:
+        close()
+        raise
+
+    def events():
+        yield ': connected\n\n'
+
+        while time.monotonic() < deadline:
+            message = subscription.get(timeout=heartbeat)
+
+            if message is None:
+                yield ': keepalive\n\n'
+                continue
+
+            channel, event = message
+
+            if event['type'] in ('post', 'retweet'):
+                subscription.add([f"post:{event['post_id']}"])
+
+            yield format_event(event)
+
+    response = Response(events(), mimetype='text/event-stream', headers={ 'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no' })
+    response.call_on_close(close)
+
+    return response
@@ -0,0 +1,277 @@
+# profile.py
+
+import heapq
+from bson import ObjectId
+from models.user import User
+from models.post import Post
+from models.retweet import Retweet
+from models.like import Like
+from models.follow import Follow
+from controllers.hydrator import hydrate_posts, hydrate_shares
+from controllers.pagination import paginate, encode_cursor, decode_cursor
+from controllers.counters import apply_pending
+
+# The profile page (the user, then their posts and retweets paged together) has two
+# engines with identical output. The Python one builds it from a few indexed queries and the
+# card cache. The aggregation one gets the user, both pages, the authors and the viewer's
+# flags from MongoDB in a single round trip, and only merges the two pages here.
+# PROFILE_ENGINE picks one, and `flask check-profile-parity` compares them on real data.
+
+
+# FUNCTION profile_user()
+def profile_user(user_id, viewer_id):
+    user = User.objects(id=user_id).first()
+
+    if user is None:
+        return None
+
+    return {
+        'id': str(user.pk),
+        'full_name': user.full_name,
+        'username': user.username,
+        'address': user.address,
+        'birthday': user.birthday,
+        'bio': user.bio,
+        'followers': user.followers_count,
+        'following': user.following_count,
+        'isFollower': Follow.objects(follower=viewer_id, following=user_id).first() is not None
+    }
+
+
+# FUNCTION profile_page()
+# Posts and retweets are paginated together, newest first.
+def profile_page(user_id, args):
+    return paginate(
+        Post.objects(author=user_id, deleted__ne=True).only('id'),
+        Retweet.objects(user_id=user_id).no_dereference(),
+        **args
+    )
+
+
+# FUNCTION profile_body()
+def profile_body(user, page, next_cursor, viewer_id):
+    return {
+        'get': True,
+        'user': user,
+        'posts': hydrate_posts([item.id for item in page if isinstance(item, Post)], viewer_id),
+        'retweets': hydrate_shares([item for item in page if isinstance(item, Retweet)], viewer_id),
+        'next_cursor': next_cursor
+    }
+
+
+# FUNCTION load_profile()
+# The Python engine. Returns None when the user does not exist.
+def load_profile(user_id, viewer_id, args):
+    user = profile_user(user_id, viewer_id)
+
+    if user is None:
+        return None
+
+    return profile_body(user, *profile_page(user_id, args), viewer_id)
+
+
+# FUNCTION summary_stages()
+# Looks up the summary of the user in `field` into `target`.
+def summary_stages(field, target):
+    return [{ '$lookup': {
+        'from': User._get_collection_name(),
+        'let': { 'user': f'${field}' },
+        'pipeline': [
+            { '$match': { '$expr': { '$eq': ['$_id', '$$user'] } } },
+            { '$project': { '_id': 0, 'id': { '$toString': '$_id' }, 'full_name': 1, 'username': 1 } }
+        ],
+        'as': target
+    } }]
+
+
+# FUNCTION flag_stage()
+# Looks up whether the viewer has a like or retweet on the post into `target`.
+def flag_stage(document, viewer_id, target):
+    return { '$lookup': {
+        'from': document._get_collection_name(),
+        'let': { 'post': '$_id' },
+        'pipeline': [
+            { '$match': { 'user_id': viewer_id, '$expr': { '$eq': ['$post_id', '$$post'] } } },
+            { '$limit': 1 },
+            { '$project': { '_id': 1 } }
+        ],
+        'as': target
+    } }
+
+
+# FUNCTION card_stages()
+# Turns post documents into the same cards hydrate_posts() builds, keeping _id as `key`.
+def card_stages(viewer_id):
+    return summary_stages('author', 'author_summary') + [
+        flag_stage(Retweet, viewer_id, 'retweeted'),
+        flag_stage(Like, viewer_id, 'liked'),
+        { '$project': {
+            '_id': 0,
+            'key': '$_id',
+            'id': { '$toString': '$_id' },
+            'text': 1,
+            'date': { '$ifNull': ['$date', None] },
+            'images': { '$ifNull': ['$images.url', []] },
+            'media_status': { '$ifNull': ['$media_status', 'ready'] },
+            'parent': { '$toString': '$parent' },
+            'retweets_count': { '$ifNull': ['$retweets_count', 0] },
+            'comments_count': { '$ifNull': ['$comments_count', 0] },
+            'likes_count': { '$ifNull': ['$likes_count', 0] },
+            'author': { '$ifNull': [{ '$arrayElemAt': ['$author_summary', 0] }, None] },
+            'didRetweet': { '$gt': [{ '$size': '$retweeted' }, 0] },
+            'didLike': { '$gt': [{ '$size': '$liked' }, 0] },
+            'isAuthor': { '$eq': ['$author', viewer_id] }
+        } }
+    ]
+
+
+# FUNCTION page_stages()
+# Range, order and limit of one source, matching paginate().
+def page_stages(match, limit, before, after):
+    if before is not None:
+        match['_id'] = { '$lt': before }
+    if after is not None:
+        match['_id'] = { **match.get('_id', {}), '$gt': after }
+
+    return [{ '$match': match }, { '$sort': { '_id': 1 if after is not None else -1 } }, { '$limit': limit + 1 }]
+
+
+# FUNCTION profile_pipeline()
+def profile_pipeline(user_id, viewer_id, limit, before, after):
+    posts = page_stages({ 'author': user_id, 'deleted': { '$ne': True } }, limit, before, after) + card_stages(viewer_id)
+
+    retweets = page_stages({ 'user_id': user_id }, limit, before, after) + summary_stages('user_id', 'sharer') + [
+        { '$lookup': {
+            'from': Post._get_collection_name(),
+            'let': { 'post': '$post_id' },
+            'pipeline': [{ '$match': { '$expr': { '$eq': ['$_id', '$$post'] }, 'deleted': { '$ne': True } } }] + card_stages(viewer_id),
+            'as': 'post'
+        } },
+        { '$project': {
+            '_id': 0,
+            'key': '$_id',
+            'id': { '$toString': '$_id' },
+            'user_id': { '$arrayElemAt': ['$sharer', 0] },
+            'post_id': { '$arrayElemAt': ['$post', 0] }
+        } }
+    ]
+
+    return [
+        { '$match': { '_id': user_id } },
+        { '$facet': {
+            'user': [
+                { '$lookup': {
+                    'from': Follow._get_collection_name(),
+                    'pipeline': [{ '$match': { 'follower': viewer_id, 'following': user_id } }, { '$limit': 1 }],
+                    'as': 'follow'
+                } },
+                { '$project': {
+                    '_id': 0,
+                    'id': { '$toString': '$_id' },
+                    'full_name': 1,
+                    'username': 1,
+                    'address': { '$ifNull': ['$address', None] },
+                    'birthday': { '$ifNull': ['$birthday', None] },
+                    'bio': { '$ifNull': ['$bio', None] },
+                    'followers': { '$ifNull': ['$followers_count', 0] },
+                    'following': { '$ifNull': ['$following_count', 0] },
+                    'isFollower': { '$gt': [{ '$size': '$follow' }, 0] }
+                } }
+            ],
+            'posts': [
+                { '$lookup': { 'from': Post._get_collection_name(), 'pipeline': posts, 'as': 'items' } },
+                { '$unwind': '$items' },
+                { '$replaceRoot': { 'newRoot': '$items' } }
+            ],
+            'retweets': [
+                { '$lookup': { 'from': Retweet._get_collection_name(), 'pipeline': retweets, 'as': 'items' } },
+                { '$unwind': '$items' },
+                { '$replaceRoot': { 'newRoot': '$items' } }
+            ]
+        } }
+    ]
+
+
+# FUNCTION aggregate_profile()
+# The aggregation engine. Returns None when the user does not exist.
+def aggregate_profile(user_id, viewer_id, args):
+    user_id, viewer_id = ObjectId(str(user_id)), ObjectId(str(viewer_id))
+    limit, before, after = args['limit'], args['before'], args['after']
+
+    result = next(User._get_collection().aggregate(profile_pipeline(user_id, viewer_id, limit, before, after)), None)
+
+    if result is None or not result['user']:
+        return None
+
+    # Both sources come back in page order; merged and cut like paginate() does
+    sources = [[(item['key'], 'post', item) for item in result['posts']], [(item['key'], 'retweet', item) for item in result['retweets']]]
+    rows = []
+    seen = set()
+
+    for key, kind, item in heapq.merge(*sources, key=lambda row: row[0], reverse=after is None):
+        if key in seen:
+            continue
+
+        seen.add(key)
+        rows.append((key, kind, item))
+
+        if len(rows) > limit:
+            break
+
+    next_cursor = encode_cursor(rows[limit - 1][0]) if len(rows) > limit else None
+    page = rows[:limit]
+
+    if after is not None:
+        page.reverse()
+
+    for key, kind, item in page:
+        del item['key']
+
+        if kind == 'retweet' and 'post_id' in item:
+            del item['post_id']['key']
+
+    # Counter deltas still in the write buffer are added the way hydrate_posts() does
+    apply_pending([item for key, kind, item in page if kind == 'post'] + [item['post_id'] for key, kind, item in page if kind == 'retweet' and 'post_id' in item])
+
+    return {
+        'get': True,
+        'user': result['user'][0],
+        'posts': [item for key, kind, item in page if kind == 'post'],
+        'retweets': [item for key, kind, item in page if kind == 'retweet' and 'user_id' in item and 'post_id' in item],
+        'next_cursor': next_cursor
+    }
+
+
+# FUNCTION compare_engines()
+# Runs both engines over the first `pages` pages towards older items, then one page back
+# towards newer ones from the end of the last page. Returns the number of pages compared and
+# the (args, keys that differ) of every page on which the engines disagree.
+def compare_engines(user_id, viewer_id, pages, limit):
+    args = { 'limit': limit, 'before': None, 'after': None }
+    compared = 0
+    mismatches = []
+
+    def compare(args):
+        python = load_profile(user_id, viewer_id, args)
+        aggregation = aggregate_profile(user_id, viewer_id, args)
+
+        if python != aggregation:
+            keys = [key for key in python if python[key] != aggregation.get(key)] if python and aggregation else ['user']
+            mismatches.append((args, keys))
+
+        return python
+
+    for _ in range(pages):
+        python = compare(args)
+        compared += 1
+
+        if python is None or python['next_cursor'] is None:
+            break
+
+        args = { 'limit': limit, 'before': decode_cursor(python['next_cursor']), 'after': None }
+
+    if args['before'] is not None:
+        compare({ 'limit': limit, 'before': None, 'after': args['before'] })
+        compared += 1
+
+    return compared, mismatches
@@ -0,0 +1,72 @@
+# purge.py
+
+from bson import ObjectId
+from models.post import Post
+from models.retweet import Retweet
+from models.like import Like
+from models.timeline import TimelineEntry
+from controllers.jobs import submit, with_retries
+from controllers.media import media_backend
+from controllers.cache import invalidate_posts
+
+# Deleting a post only tombstones it in the request. The subtree is removed here in the
+# background: its ids are collected with one query on the ancestors index, the rows that
+# point to them are removed with batched delete_many calls, and the images are deleted
+# from the media backend in batches with retries. The root goes last, so a purge that dies
+# halfway is resumed by `flask purge-deleted`.
+
+BATCH_SIZE = 1000
+CLOUDINARY_BATCH_SIZE = 100 # Most public ids accepted by one delete_resources call
+
+
+# FUNCTION delete_images()
+def delete_images(posts, backend):
+    public_ids = []
+
+    for post in posts:
+        if post.get('img_path') is None:
+            continue
+
+        ids = [image['public_id'] for image in post.get('images', []) if image.get('public_id')]
+
+        # Posts uploaded before public ids were stored are deleted by folder
+        if ids:
+            public_ids += ids
+        else:
+            with_retries(backend.delete_resources_by_prefix, post['img_path'])
+
+    for start in range(0, len(public_ids), CLOUDINARY_BATCH_SIZE):
+        with_retries(backend.delete_resources, public_ids[start:start + CLOUDINARY_BATCH_SIZE])
+
+    for post in posts:
+        if post.get('img_path') is not None:
+            with_retries(backend.delete_folder, post['img_path'])
+
+
+# FUNCTION purge_post()
+def purge_post(post_id, backend):
+    post_id = ObjectId(str(post_id))
+    root = Post.objects(id=post_id).only('img_path', 'images').as_pymongo().first()
+
+    if root is None:
+        return
+
+    replies = list(Post.objects(ancestors=post_id).only('img_path', 'images', 'depth').as_pymongo())
+    delete_images([root] + replies, backend)
+
+    # Deepest rows first, so every batch only removes rows nothing else still needs
+    post_ids = [reply['_id'] for reply in sorted(replies, key=lambda reply: reply.get('depth', 0), reverse=True)] + [post_id]
+
+    for start in range(0, len(post_ids), BATCH_SIZE):
+        batch = post_ids[start:start + BATCH_SIZE]
+
+        TimelineEntry._get_collection().delete_many({ 'post_id': { '$in': batch } })
+        Like._get_collection().delete_many({ 'post_id': { '$in': batch } })
+        Retweet._get_collection().delete_many({ 'post_id': { '$in': batch } })
+        Post._get_collection().delete_many({ '_id': { '$in': batch } })
+        invalidate_posts(*batch)
+
+
+# FUNCTION delete_in_background()
+def delete_in_background(post_id):
+    submit(purge_post, post_id, media_backend())
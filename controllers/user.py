@@ -1,13 +1,21 @@
 # user.py
 
 from datetime import datetime
-from flask import Blueprint, request
+from bson import ObjectId
+from flask import Blueprint, request, current_app
 from flask_jwt_extended import create_access_token, create_refresh_token ,get_jwt_identity, jwt_required
 from models.user import User
 from models.post import Post
-from models.retweet import Retweet
 from models.like import Like
-from cloudinary import api
+from models.follow import Follow
+from mongoengine import NotUniqueError
+from controllers.hydrator import hydrate_shares, load_authors
+from controllers.cache import invalidate_users
+from controllers.identity import load_documents
+from controllers.pagination import page_args, paginate
+from controllers.etag import make_etag, not_modified, etag_response, post_versions, user_versions
+from controllers.fanout import follow_inbox, unfollow_inbox
+from controllers.profile import profile_user, profile_page, profile_body, aggregate_profile
 import pprint
 
 user_bp = Blueprint('user_bp', __name__)
@@ -21,7 +29,7 @@ def register():
     password = data['password']
 
     user = User(full_name=full_name, username=username, password=User.createPassword(password))
-    duplicated = User.objects(username__iexact=username)
+    duplicated = User.objects(username_lower=username.lower())
 
     if not duplicated:
         user.save()
@@ -30,8 +38,7 @@ def register():
             'user': {
                 'id': str(user.id),
                 'full_name': user.full_name,
-                'username': user.username,
-                'password': user.password
+                'username': user.username
             }
         }, 201
     else:
@@ -48,6 +55,10 @@ def login():
     user = User.objects(username=username).first()
 
     if user is not None and user.verifyPassword(password):
+        # Hashes made with an older cost are upgraded on the next successful login
+        if user.needsRehash():
+            user.update(password=User.createPassword(password))
+
         accessToken = create_access_token(identity=str(user.pk))
         refreshToken = create_refresh_token(identity=str(user.pk))
 
@@ -75,179 +86,87 @@ def refresh_token():
 @user_bp.route('/user/<string:user_id>', methods=['GET'])
 @jwt_required()
 def get_user_posts(user_id):
-    user_obj = User.objects(id=user_id).first()
-
-    isFollower = False
-    for follower in user_obj.followers:
-        if str(follower.id) == get_jwt_identity():
-            isFollower = True
-
-    user = {
-        'id': str(user_obj.pk),
-        'full_name': user_obj.full_name,
-        'username': user_obj.username,
-        'address': user_obj.address,
-        'birthday': user_obj.birthday,
-        'bio': user_obj.bio,
-        'followers': len(user_obj.followers),
-        'following': len(user_obj.following),
-        'isFollower': isFollower
-    }
-
-    posts = []
-
-    for post in Post.objects(author=user_id).order_by('-id'):
-        if post.img_path is not None:
-            images_resources = api.resources(type='upload', prefix=post.img_path)['resources']
-            images = [image['secure_url'] for image in images_resources]
-        else:
-            images = []
-        
-        didRetweet = False
-        for retweet in Retweet.objects(post_id=str(post.id)):
-            if str(retweet.user_id.id) == get_jwt_identity():
-                didRetweet = True
-        
-        didLike = False
-        for like in Like.objects(post_id=str(post.id)):
-            if str(like.user_id.id) == get_jwt_identity():
-                didLike = True
-        
-        posts.append({
-            'id': str(post.pk),
-            'text': post.text,
-            'date': post.date,
-            'images': images,
-            'retweets_count': Retweet.objects(post_id=str(post.pk)).count(),
-            'comments_count': Post.objects(parent=str(post.id)).count(),
-            'likes_count': Like.objects(post_id=str(post.id)).count(),
-            'didRetweet': didRetweet,
-            'didLike': didLike,
-            'parent': post.parent
-        })
-
-    retweets = []
-
-    for retweet in Retweet.objects(user_id=user_id).order_by('-id'):
-        if retweet.post_id.img_path is not None:
-            retweet_resources = api.resources(type='upload', prefix=retweet.post_id.img_path)['resources']
-            retweet_images = [image['secure_url'] for image in retweet_resources]
-        else:
-            retweet_images = []
-        
-        didRetweetPost = False
-        for r in Retweet.objects(post_id=str(retweet.post_id.id)):
-            if str(r.user_id.id) == get_jwt_identity():
-                didRetweetPost = True
-        
-        didLikePost = False
-        for like in Like.objects(post_id=str(retweet.post_id.id)):
-            if str(like.user_id.id) == get_jwt_identity():
-                didLikePost = True
-
-        retweets.append({
-            'id': str(retweet.id),
-            'post_id': {
-                'id': str(retweet.post_id.id),
-                'author': retweet.post_id.author,
-                'text': retweet.post_id.text,
-                'date': retweet.post_id.date,
-                'images': retweet_images,
-                'didRetweet': didRetweetPost,
-                'didLike': didLikePost,
-                'retweets_count': Retweet.objects(post_id=str(retweet.post_id.id)).count(),
-                'comments_count': Post.objects(parent=str(retweet.post_id.id)).count(),
-                'likes_count': Like.objects(post_id=str(retweet.post_id.id)).count()
-            }
-        })
-
-    # likes = []
-
-    # for like in Like.objects(user_id=user_id):
-    #     if like.post_id.img_path is not None:
-    #         like_resources = api.resources(type='upload', prefix=like.post_id.img_path)['resources']
-    #         like_images = [image['secure_url'] for image in like_resources]
-    #     else:
-    #         like_images = []
-        
-    #     didRetweetLike = False
-    #     for retweet in Retweet.objects(post_id=str(like.post_id.id)):
-    #         if str(retweet.user_id.id) == get_jwt_identity():
-    #             didRetweetLike = True
-        
-    #     didLike_Like = False
-    #     for l in Like.objects(post_id=str(like.post_id.id)):
-    #         if str(l.user_id.id) == get_jwt_identity():
-    #             didLike_Like = True
-        
-
-    #     likes.append({
-    #         'id': str(like.id),
-    #         'post_id': {
-    #             'id': str(like.post_id.id),
-    #             'author': like.post_id.author,
-    #             'text': like.post_id.text,
-    #             'date': like.post_id.date,
-    #             'images': like_images,
-    #             'didRetweet': didRetweetLike,
-    #             'didLike': didLike_Like,
-    #             'retweets_count': Retweet.objects(post_id=str(like.post_id.id)).count(),
-    #             'comments_count': Post.objects(parent=str(like.post_id.id)).count(),
-    #             'likes_count': Like.objects(post_id=str(like.post_id.id)).count()
-    #         }
-    #     })
-
-    return {
-            'get': True,
-            'user': user,
-            'posts': posts,
-            'retweets': retweets,
-            # 'likes': likes
-        }, 200
+    args = page_args()
+
+    # The aggregation engine answers in one round trip, so its ETag is taken from the body
+    if current_app.config['PROFILE_ENGINE'] == 'aggregation':
+        body = aggregate_profile(user_id, get_jwt_identity(), args)
+
+        if body is None:
+            return { 'get': False, 'message': 'User not found' }, 409
+
+        etag = make_etag(get_jwt_identity(), body)
+        return etag_response(etag) if not_modified(etag) else etag_response(etag, body)
+
+    user = profile_user(user_id, get_jwt_identity())
+
+    if user is None:
+        return { 'get': False, 'message': 'User not found' }, 409
+
+    page, next_cursor = profile_page(user_id, args)
+    etag = make_etag(get_jwt_identity(), user, next_cursor, [str(item.id) for item in page],
+    post_versions([item.id if isinstance(item, Post) else item.post_id.id for item in page], get_jwt_identity()))
+
+    if not_modified(etag):
+        return etag_response(etag)
+
+    return etag_response(etag, profile_body(user, page, next_cursor, get_jwt_identity()))
 
 
 # get_user_likes
 @user_bp.route('/user/likes/<string:user_id>', methods=['GET'])
 @jwt_required()
 def get_user_likes(user_id):
-    likes = []
-
-    for like in Like.objects(user_id=user_id).order_by('-id'):
-        if like.post_id.img_path is not None:
-            like_resources = api.resources(type='upload', prefix=like.post_id.img_path)['resources']
-            like_images = [image['secure_url'] for image in like_resources]
-        else:
-            like_images = []
-        
-        didRetweetLike = False
-        for retweet in Retweet.objects(post_id=str(like.post_id.id)):
-            if str(retweet.user_id.id) == get_jwt_identity():
-                didRetweetLike = True
-        
-        didLike_Like = False
-        for l in Like.objects(post_id=str(like.post_id.id)):
-            if str(l.user_id.id) == get_jwt_identity():
-                didLike_Like = True
-        
-
-        likes.append({
-            'id': str(like.id),
-            'post_id': {
-                'id': str(like.post_id.id),
-                'author': like.post_id.author,
-                'text': like.post_id.text,
-                'date': like.post_id.date,
-                'images': like_images,
-                'didRetweet': didRetweetLike,
-                'didLike': didLike_Like,
-                'retweets_count': Retweet.objects(post_id=str(like.post_id.id)).count(),
-                'comments_count': Post.objects(parent=str(like.post_id.id)).count(),
-                'likes_count': Like.objects(post_id=str(like.post_id.id)).count()
-            }
-        })
+    page, next_cursor = paginate(Like.objects(user_id=user_id).no_dereference(), **page_args())
+    etag = make_etag(get_jwt_identity(), next_cursor, [str(like.id) for like in page],
+    post_versions([like.post_id.id for like in page], get_jwt_identity()), user_versions([user_id]))
+
+    if not_modified(etag):
+        return etag_response(etag)
+
+    likes = hydrate_shares(page, get_jwt_identity())
     
-    return { 'likes': likes }
+    return etag_response(etag, { 'likes': likes, 'next_cursor': next_cursor })
+
+
+
+# FUNCTION followPage()
+# Pages the edges on one side of a user's follow graph and summarizes the users on the other.
+# The ETag of the page is returned along with it; users is None when the client's copy is current.
+def followPage(edges, field):
+    page, next_cursor = paginate(edges.no_dereference(), **page_args())
+    etag = make_etag(next_cursor, [str(follow.id) for follow in page], user_versions(getattr(follow, field).id for follow in page))
 
+    if not_modified(etag):
+        return None, next_cursor, etag
+
+    users = load_authors(getattr(follow, field).id for follow in page)
+
+    return [users[getattr(follow, field).id] for follow in page if getattr(follow, field).id in users], next_cursor, etag
+
+
+# get_followers()
+@user_bp.route('/user/<string:user_id>/followers', methods=['GET'])
+@jwt_required()
+def get_followers(user_id):
+    followers, next_cursor, etag = followPage(Follow.objects(following=user_id), 'follower')
+
+    if followers is None:
+        return etag_response(etag)
+
+    return etag_response(etag, { 'get': True, 'followers': followers, 'next_cursor': next_cursor })
+
+
+# get_following()
+@user_bp.route('/user/<string:user_id>/following', methods=['GET'])
+@jwt_required()
+def get_following(user_id):
+    following, next_cursor, etag = followPage(Follow.objects(follower=user_id), 'following')
+
+    if following is None:
+        return etag_response(etag)
+
+    return etag_response(etag, { 'get': True, 'following': following, 'next_cursor': next_cursor })
 
 
 # logout()
@@ -261,12 +180,22 @@ def logout():
 @user_bp.route('/follow/<string:user_id>', methods=['POST'])
 @jwt_required()
 def follow_user(user_id):
-    user_following = User.objects(id=get_jwt_identity()).first()
-    user_followed = User.objects(id=user_id).first()
+    if user_id == get_jwt_identity():
+        return { 'follow': False, 'message': 'Cannot follow yourself' }, 409
+
+    users = load_documents(User, [get_jwt_identity(), user_id])
+    user_following = users.get(ObjectId(get_jwt_identity()))
+    user_followed = users.get(ObjectId(user_id))
 
     if user_following is not None and user_followed is not None:
-        User.objects(id=get_jwt_identity()).update_one(push__following=user_followed)
-        User.objects(id=user_id).update_one(push__followers=user_following)
+        try:
+            Follow(follower=user_following, following=user_followed).save()
+        except NotUniqueError:
+            return { 'follow': False, 'message': 'Already following' }, 409
+
+        User.objects(id=user_following.id).update_one(inc__following_count=1)
+        User.objects(id=user_followed.id).update_one(inc__followers_count=1)
+        follow_inbox(user_following.id, user_followed.id)
 
         return {
             'follow': True,
@@ -281,12 +210,20 @@ def follow_user(user_id):
 @user_bp.route('/follow/<string:user_id>', methods=['DELETE'])
 @jwt_required()
 def unfollow_user(user_id):
-    user_unfollowing = User.objects(id=get_jwt_identity()).first()
-    user_unfollowed = User.objects(id=user_id).first()
+    if user_id == get_jwt_identity():
+        return { 'unfollow': False, 'message': 'Cannot follow yourself' }, 409
+
+    users = load_documents(User, [get_jwt_identity(), user_id])
+    user_unfollowing = users.get(ObjectId(get_jwt_identity()))
+    user_unfollowed = users.get(ObjectId(user_id))
 
     if user_unfollowing is not None and user_unfollowed is not None:
-        User.objects(id=get_jwt_identity()).update_one(pull__following=user_unfollowed)
-        User.objects(id=user_id).update_one(pull__followers=user_unfollowing)
+        if not Follow.objects(follower=user_unfollowing, following=user_unfollowed).delete():
+            return { 'unfollow': False, 'message': 'Not following' }, 409
+
+        User.objects(id=user_unfollowing.id).update_one(dec__following_count=1)
+        User.objects(id=user_unfollowed.id).update_one(dec__followers_count=1)
+        unfollow_inbox(user_unfollowing.id, user_unfollowed.id)
 
         return {
             'unfollow': True,
@@ -305,7 +242,8 @@ def edit_user():
     
     full_name = data['full_name']
     username = data['username']
-    password = data['password']
+    password = data.get('password')
+    new_password = data.get('new_password')
     address = data['address']
     birthday = data['birthday']
     bio = data['bio']
@@ -316,7 +254,17 @@ def edit_user():
     user = User.objects(id=get_jwt_identity()).first()
 
     if user is not None:
-        user.update(full_name=full_name, username=username, password=User.createPassword(password), address=address, birthday=birthday_obj, bio=bio)
+        # A password change is sent as new_password. The password that older clients send with
+        # every edit is only hashed again when the stored hash uses an outdated cost; it is not
+        # verified, so an edit without new_password costs at most one bcrypt round
+        if new_password:
+            user.update(password=User.createPassword(new_password))
+        elif password and user.needsRehash():
+            user.update(password=User.createPassword(password))
+
+        user.update(full_name=full_name, username=username, address=address, birthday=birthday_obj, bio=bio,
+        inc__version=1, **User.searchFields(full_name, username))
+        invalidate_users(user.id)
         user.reload()
 
         return {
@@ -325,7 +273,6 @@ def edit_user():
                 'id': str(user.id),
                 'full_name': user.full_name,
                 'username': user.username,
-                'password': user.password,
                 'address': user.address,
                 'birthday': user.birthday,
                 'bio': user.bio
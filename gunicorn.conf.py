@@ -0,0 +1,29 @@
+# gunicorn.conf.py
+
+import os
+
+# Handlers spend most of their time waiting on MongoDB and Cloudinary, so each process runs
+# several threads. Keep MONGODB_MAX_POOL_SIZE at or above the thread count. Each open
+# /timeline/stream holds a thread for up to STREAM_MAX_SECONDS, and a process serves at most
+# STREAM_MAX_OPEN streams, so raise GUNICORN_THREADS along with it.
+wsgi_app = 'app:create_app()'
+bind = f'0.0.0.0:{os.environ.get("PORT", "8000")}'
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+keepalive = 5
+preload_app = True # Safe: the Mongo client connects lazily and pools start on first use
+
+
+# Metrics are served by the master on METRICS_BIND, summed over the workers' snapshots
+def on_starting(server):
+    from config import Config
+    from controllers.metrics import clear_snapshots
+    clear_snapshots(Config.METRICS_DIR)
+
+
+def when_ready(server):
+    from config import Config
+    from controllers.metrics import serve_metrics
+    serve_metrics(Config.METRICS_BIND, Config.METRICS_DIR)
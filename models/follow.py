@@ -0,0 +1,16 @@
+# follow.py
+
+import mongoengine
+from app import db
+
+class Follow(db.Document):
+    follower = db.ReferenceField('User', required=True, reverse_delete_rule=mongoengine.CASCADE)
+    following = db.ReferenceField('User', required=True, reverse_delete_rule=mongoengine.CASCADE)
+
+    meta = {
+        'indexes': [
+            { 'fields': ('follower', 'following'), 'unique': True },
+            ('follower', '-id'),
+            ('following', '-id')
+        ]
+    }
@@ -1,13 +1,51 @@
 # post.py
 
 import datetime
+import re
 
 import mongoengine
 from app import db
 
+HASHTAG_RE = re.compile(r'#(\w+)')
+MENTION_RE = re.compile(r'@(\w+)')
+
+class Image(db.EmbeddedDocument):
+    url = db.StringField(required=True)
+    public_id = db.StringField()
+    width = db.IntField()
+    height = db.IntField()
+    bytes = db.IntField()
+
 class Post(db.Document):
     author = db.ReferenceField('User', required=True, reverse_delete_rule=mongoengine.CASCADE)
     text = db.StringField(required=True, max_length=280)
     date = db.DateTimeField(default=datetime.datetime.now())
     img_path = db.StringField()
+    images = db.ListField(db.EmbeddedDocumentField(Image))
+    media_status = db.StringField(choices=('pending', 'ready', 'failed'), default='ready')
     parent = db.ReferenceField('self', reverse_delete_rule=mongoengine.CASCADE)
+    ancestors = db.ListField(db.ObjectIdField()) # Root first, parent last
+    depth = db.IntField(default=0)
+    deleted = db.BooleanField(default=False) # Tombstone until the cascade delete finishes
+    hashtags = db.ListField(db.StringField())
+    mentions = db.ListField(db.StringField())
+    likes_count = db.IntField(default=0)
+    retweets_count = db.IntField(default=0)
+    comments_count = db.IntField(default=0)
+
+    meta = {
+        'indexes': [
+            ('parent', '-id'),
+            ('author', '-id'),
+            ('ancestors', 'depth'),
+            { 'fields': ['$text'], 'default_language': 'none' },
+            ('hashtags', '-id'),
+            ('mentions', '-id'),
+            { 'fields': ['deleted'], 'partialFilterExpression': { 'deleted': True } }
+        ]
+    }
+
+    # clean()
+    def clean(self):
+        self.hashtags = sorted({ tag.lower() for tag in HASHTAG_RE.findall(self.text or '') })
+        self.mentions = sorted({ username.lower() for username in MENTION_RE.findall(self.text or '') })
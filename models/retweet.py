@@ -5,4 +5,15 @@ from app import db
 
 class Retweet(db.Document):
     user_id = db.ReferenceField('User', required=True, reverse_delete_rule=mongoengine.CASCADE)
-    post_id = db.ReferenceField('Post', required=True, reverse_delete_rule=mongoengine.CASCADE)
\ No newline at end of file
+    post_id = db.ReferenceField('Post', required=True, reverse_delete_rule=mongoengine.CASCADE)
+
+    # Indexes are built by `flask build-indexes`, which first removes the duplicates the
+    # unique index would reject
+    meta = {
+        'auto_create_index': False,
+        'indexes': [
+            { 'fields': ('user_id', 'post_id'), 'unique': True },
+            ('user_id', '-id'),
+            'post_id'
+        ]
+    }
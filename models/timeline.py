@@ -0,0 +1,20 @@
+# timeline.py
+
+import mongoengine
+from app import db
+
+class TimelineEntry(db.Document):
+    owner = db.ReferenceField('User', required=True, reverse_delete_rule=mongoengine.CASCADE)
+    actor = db.ReferenceField('User', required=True, reverse_delete_rule=mongoengine.CASCADE)
+    item_id = db.ObjectIdField(required=True)
+    post_id = db.ReferenceField('Post', required=True, reverse_delete_rule=mongoengine.CASCADE)
+    retweet_id = db.ReferenceField('Retweet', reverse_delete_rule=mongoengine.CASCADE)
+
+    meta = {
+        'indexes': [
+            { 'fields': ('owner', '-item_id'), 'unique': True },
+            ('owner', 'actor'),
+            'post_id',
+            { 'fields': ['retweet_id'], 'sparse': True }
+        ]
+    }
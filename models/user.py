@@ -1,11 +1,31 @@
 # user.py
 
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
 from app import db
 from flask_bcrypt import Bcrypt
-import mongoengine
 
 bcrypt = Bcrypt()
 
+# bcrypt releases the GIL while hashing, so hashes run on a bounded pool of threads: a
+# burst of logins is capped at PASSWORD_WORKERS cores instead of stalling every worker.
+password_executor = None
+password_executor_lock = threading.Lock()
+
+
+# FUNCTION hash_in_pool()
+def hash_in_pool(function, *args):
+    global password_executor
+
+    if password_executor is None:
+        with password_executor_lock:
+            if password_executor is None:
+                password_executor = ThreadPoolExecutor(max_workers=current_app.config['PASSWORD_WORKERS'], thread_name_prefix='bcrypt')
+
+    return password_executor.submit(function, *args).result()
+
+
 class User(db.Document):
     full_name = db.StringField(required=True, max_length=50)
     username = db.StringField(required=True, max_length=30, unique=True)
@@ -13,13 +33,40 @@ class User(db.Document):
     address = db.StringField()
     birthday = db.DateTimeField()
     bio = db.StringField()
-    followers = db.ListField(db.ReferenceField('self', reverse_delete_rule=mongoengine.CASCADE))
-    following = db.ListField(db.ReferenceField('self', reverse_delete_rule=mongoengine.CASCADE))
+    followers_count = db.IntField(default=0)
+    following_count = db.IntField(default=0)
+    username_lower = db.StringField()
+    name_tokens = db.ListField(db.StringField()) # Lowercased words of full_name for typeahead
+    version = db.IntField(default=0) # Bumped on every profile edit, part of the ETags of pages that show the user
+
+    # Follow edges live in their own collection; strict is off so documents that still
+    # carry the old embedded followers/following lists load until `flask migrate-follows`
+    meta = {
+        'indexes': ['username_lower', 'name_tokens'],
+        'strict': False
+    }
+
+    # searchFields()
+    def searchFields(full_name, username):
+        return {
+            'username_lower': username.lower(),
+            'name_tokens': sorted(set(full_name.lower().split()))
+        }
+
+    # clean()
+    def clean(self):
+        for field, value in User.searchFields(self.full_name or '', self.username or '').items():
+            setattr(self, field, value)
 
     # createPassword()
     def createPassword(password):
-        return bcrypt.generate_password_hash(password).decode('utf-8')
+        return hash_in_pool(bcrypt.generate_password_hash, password, current_app.config['BCRYPT_LOG_ROUNDS']).decode('utf-8')
 
     # verifyPassword()
     def verifyPassword(self, password):
-        return bcrypt.check_password_hash(self.password, password)
\ No newline at end of file
+        return hash_in_pool(bcrypt.check_password_hash, self.password, password)
+
+    # needsRehash()
+    # True when the stored hash was made with a cost other than BCRYPT_LOG_ROUNDS.
+    def needsRehash(self):
+        return int(self.password.split('$')[2]) != current_app.config['BCRYPT_LOG_ROUNDS']
\ No newline at end of file
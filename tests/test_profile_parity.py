@@ -0,0 +1,136 @@
+# test_profile_parity.py
+#
+# Compares the Python and aggregation profile engines on a seeded graph, page by page, for
+# the owner of each profile, a follower and a stranger. The aggregation engine uses operators
+# mongomock does not implement, so the test runs against a real mongod and is skipped when
+# none answers:
+#
+#   PARITY_MONGODB_HOST='mongodb://localhost:27017/hashtage_parity_test?tlsCAFile=' python -m unittest discover -s tests
+#
+# The database is dropped before and after the test, so its name must contain "test".
+
+import datetime
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+HOST = os.environ.get('PARITY_MONGODB_HOST', 'mongodb://localhost:27017/hashtage_parity_test?tlsCAFile=')
+
+
+# FUNCTION setUpModule()
+# Skips the module unless a mongod answers. The environment is set before the app is
+# imported, since config.py reads it at import time.
+def setUpModule():
+    import pymongo
+
+    if 'test' not in HOST.split('?')[0].rsplit('/', 1)[-1]:
+        raise unittest.SkipTest(f'Refusing to drop {HOST}: the database name must contain "test"')
+
+    try:
+        pymongo.MongoClient(HOST.split('?')[0], serverSelectionTimeoutMS=1000).admin.command('ping')
+    except pymongo.errors.PyMongoError as error:
+        raise unittest.SkipTest(f'No mongod at {HOST}: {error}')
+
+    os.environ['MONGODB_HOST'] = HOST
+    os.environ['CACHE_BACKEND'] = 'none'
+    os.environ['COUNTER_FLUSH_SECONDS'] = '0'
+
+    for name in ('SECRET_KEY', 'JWT_SECRET_KEY', 'CLOUD_NAME', 'API_KEY', 'API_SECRET'):
+        os.environ.setdefault(name, 'test')
+
+
+# CLASS ProfileParityTest
+class ProfileParityTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        from app import create_app
+
+        cls.app = create_app()
+        cls.context = cls.app.app_context()
+        cls.context.push()
+        cls.drop()
+        cls.users = cls.seed()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.drop()
+        cls.context.pop()
+
+    @staticmethod
+    def drop():
+        from models.post import Post
+
+        Post._get_db().client.drop_database(Post._get_db().name)
+
+    # seed()
+    # Posts, replies, a tombstoned post, a post with pending media, a post written without
+    # counters or media status, and retweets and likes across four authors.
+    @staticmethod
+    def seed():
+        from models.user import User
+        from models.post import Post, Image
+        from models.follow import Follow
+        from models.like import Like
+        from models.retweet import Retweet
+
+        users = [User(full_name=f'Parity User {index}', username=f'parity{index}', password='x', bio=f'Bio {index}').save() for index in range(6)]
+        start = datetime.datetime(2024, 1, 1)
+        posts = []
+
+        for index in range(16):
+            posts.append(Post(
+                author=users[index % 4].id,
+                text=f'Post {index}',
+                date=start + datetime.timedelta(minutes=index),
+                likes_count=index % 3,
+                retweets_count=index % 2
+            ).save())
+
+        reply = Post(author=users[1].id, text='Reply', parent=posts[0].id, ancestors=[posts[0].id], depth=1, date=start + datetime.timedelta(hours=1)).save()
+        Post.objects(id=posts[0].id).update_one(inc__comments_count=1)
+
+        Post.objects(id=posts[4].id).update_one(set__deleted=True)
+        Post(author=users[0].id, text='Uploading', media_status='pending', date=start + datetime.timedelta(hours=2),
+            images=[Image(url='https://example.com/a.jpg', public_id='a')]).save()
+        Post._get_collection().insert_one({ 'author': users[0].id, 'text': 'Written without counters', 'date': start + datetime.timedelta(hours=3) })
+
+        for follower, following in ((1, 0), (2, 0), (0, 3), (4, 1)):
+            Follow(follower=users[follower].id, following=users[following].id).save()
+            User.objects(id=users[follower].id).update_one(inc__following_count=1)
+            User.objects(id=users[following].id).update_one(inc__followers_count=1)
+
+        for user, post in ((0, 1), (0, 2), (0, 4), (0, 6), (1, 0), (1, reply), (2, 5), (3, 8)):
+            Retweet(user_id=users[user].id, post_id=post if isinstance(post, Post) else posts[post].id).save()
+
+        for user, post in ((1, 0), (1, 1), (2, 0), (5, 3), (0, 5)):
+            Like(user_id=users[user].id, post_id=posts[post].id).save()
+
+        return [user.id for user in users]
+
+    def test_engines_match(self):
+        from controllers.profile import compare_engines
+
+        stranger = self.users[5]
+        followers = { 0: self.users[1], 1: self.users[4], 3: self.users[0] }
+
+        for index, user_id in enumerate(self.users[:5]):
+            for viewer_id in (user_id, followers.get(index, stranger), stranger):
+                for limit in (1, 3, 20):
+                    with self.subTest(user=index, viewer=str(viewer_id), limit=limit):
+                        compared, mismatches = compare_engines(user_id, viewer_id, 20, limit)
+
+                        self.assertEqual(mismatches, [])
+                        self.assertGreater(compared, 0)
+
+    def test_missing_user(self):
+        from bson import ObjectId
+        from controllers.profile import compare_engines
+
+        self.assertEqual(compare_engines(ObjectId(), self.users[0], 1, 3), (1, []))
+
+
+if __name__ == '__main__':
+    unittest.main()